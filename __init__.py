@@ -11,110 +11,264 @@ import torch.optim as optim
 from torchvision import transforms
 from torch.utils.data import DataLoader, Dataset
 import sys 
+import os
+import copy
+import contextlib
+import warnings
+from torch.nn.parallel import DistributedDataParallel
 from .file_utils import *
 from .df_utils import *
 from .architecture import *
 from .triplet_loss import *
+from .label_utils import *
+from .metrics import *
+from .clustering import *
+from .training_state import *
+from .data_utils import *
+from .distributed import *
+from .run_context import *
+from .convergence import *
+from .profiling import *
+from .precision import *
+from .sweep import *
+from .latent_index import *
 
 
-#globals
+# defaults of train_model when it is called without a RunContext
 sourceFile = ''
 lambda_regul = 5
 hard_loss = False
 triplet_margin = 0.1
+triplet_chunk_size = None
 device = torch.device('cpu')
 
-def make_matrix_from_labels(labels):
-    M = np.zeros((len(labels), len(labels)))
-    for cluster in np.unique(labels):
-        genes_in_cluster = np.where(labels == cluster)[0]
-        for geneA in genes_in_cluster:
-            for geneB in genes_in_cluster:
-                M[geneA,geneB] = 1    
-    return M
+def make_matrix_from_labels(labels, out=None, device=None, block_size=4096):
+    ''' Build the co-cluster membership matrix M[a, b] = 1 iff labels[a] == labels[b].
 
-def train_model(model, optimizer, loader, label_x, label_y, epoch, lambda_super, train_name, train, device):
+    Args:
+        labels: cluster ids of shape (N,)
+        out: optional preallocated (N, N) torch tensor to fill in place (any dtype/device)
+        device: if set (and no out), fill a new float32 tensor on this device
+        block_size: number of rows compared per broadcast
+
+    Return:
+        (N, N) numpy float array, or the filled torch tensor when out/device is given
+    '''
+    _, cluster_ids = np.unique(np.asarray(labels).reshape(-1), return_inverse=True)
+    n = len(cluster_ids)
+    if out is None and device is None:
+        M = np.empty((n, n))
+        for start in range(0, n, block_size):
+            M[start:start+block_size] = cluster_ids[start:start+block_size, None] == cluster_ids[None, :]
+        return M
+
+    if out is None:
+        out = torch.empty((n, n), dtype=torch.float32, device=device)
+    cluster_ids = torch.from_numpy(cluster_ids).to(out.device)
+    for start in range(0, n, block_size):
+        out[start:start+block_size] = torch.eq(cluster_ids[start:start+block_size, None], cluster_ids[None, :])
+    return out
+
+def train_model(model, optimizer, loader, label_x, label_y, epoch, lambda_super, train_name, train, device, context=None):
     
-    L_totals = []
-    L_reconstruction_xs = []
-    L_reconstruction_ys = []
-    L_weights = []
-    L_trip_batch_all_xs = []
-    L_trip_batch_all_ys = []
-    L_trip_batch_hard_xs = []
-    L_trip_batch_hard_ys = []
-    fraction_hard_xs = []
-    fraction_hard_ys = []
-    fraction_semi_xs = []
-    fraction_semi_ys = []
-    fraction_easy_xs =[]
-    fraction_easy_ys =[]
+    # without a run context fall back to the module-level settings
+    if context is None:
+        context = RunContext(sourceFile if sourceFile != '' else None, device, lambda_regul, triplet_margin,
+                             hard_loss, triplet_chunk_size)
 
-    model.train()
+    metrics = MetricsAccumulator(device)
 
-    # loop over all batches
-    for step, (batch_x_input, batch_y_input, batch_genes) in enumerate(loader):
+    # per-stage timing of every batch when profiling
+    profiler = context.profiler
+    stage = profiler.stage if profiler is not None else (lambda name: contextlib.nullcontext())
+    batches = profiler.iter_stage(loader) if profiler is not None else loader
 
-        batch_label_x_input = label_x[batch_genes][:, batch_genes]
-        batch_label_y_input = label_y[batch_genes][:, batch_genes]
+    model.train()
 
-        latent, reconstruct_x, reconstruct_y, latent_x, latent_y = model(batch_x_input, batch_y_input)     
+    # loop over all batches
+    for step, (batch_x_input, batch_y_input, batch_genes) in enumerate(batches):
 
-        w_x = model.decoder_h_x.weight
-        w_y = model.decoder_h_y.weight
+        batch_label_x_input = batch_labels(label_x, batch_genes)
+        batch_label_y_input = batch_labels(label_y, batch_genes)
 
-        #calculate losses..
+        with stage('forward'):
+            # the model may run under autocast, the losses are computed in float32 (the triplet
+            # losses cast the latent themselves, renormalizing low-precision unit latents)
+            with autocast(device, context.autocast_dtype):
+                latent, reconstruct_x, reconstruct_y, latent_x, latent_y = model(batch_x_input, batch_y_input)     
+            reconstruct_x, reconstruct_y = reconstruct_x.float(), reconstruct_y.float()
 
-        #sparse penalty
-        sparse_x = torch.sqrt(torch.sum(torch.sum(torch.square(w_x), axis=1)))
-        sparse_y = torch.sqrt(torch.sum(torch.sum(torch.square(w_y), axis=1)))
-        L_weight = sparse_x + sparse_y
-        
-        # triplet errors
-        L_trip_batch_hard_x = batch_hard_triplet_loss(batch_label_x_input, latent, triplet_margin, device)
-        L_trip_batch_hard_y = batch_hard_triplet_loss(batch_label_y_input, latent, triplet_margin, device)
-        L_trip_batch_all_x, _ = batch_all_triplet_loss(batch_label_x_input, latent, triplet_margin, device)
-        L_trip_batch_all_y, _ = batch_all_triplet_loss(batch_label_y_input, latent, triplet_margin, device)
+            # unwrap DistributedDataParallel
+            w_x = getattr(model, 'module', model).decoder_h_x.weight
+            w_y = getattr(model, 'module', model).decoder_h_y.weight
 
+            #calculate losses..
 
-        fraction_easy_x, fraction_semi_x, fraction_hard_x = fraction_triplets(batch_label_x_input, latent, triplet_margin, device)
-        fraction_easy_y, fraction_semi_y, fraction_hard_y = fraction_triplets(batch_label_y_input, latent, triplet_margin, device)
+            #sparse penalty
+            sparse_x = torch.sqrt(torch.sum(torch.sum(torch.square(w_x), axis=1)))
+            sparse_y = torch.sqrt(torch.sum(torch.sum(torch.square(w_y), axis=1)))
+            L_weight = sparse_x + sparse_y
 
-        #reconstruction error
-        L_reconstruction_x = torch.mean(torch.norm(reconstruct_x - batch_x_input))
-        L_reconstruction_y = torch.mean(torch.norm(reconstruct_y - batch_y_input))
+            #reconstruction error
+            L_reconstruction_x = torch.mean(torch.norm(reconstruct_x - batch_x_input))
+            L_reconstruction_y = torch.mean(torch.norm(reconstruct_y - batch_y_input))
+        
+        # triplet errors (distances shared by both label matrices)
+        with stage('triplet_loss'):
+            ((L_trip_batch_all_x, L_trip_batch_hard_x, fraction_easy_x, fraction_semi_x, fraction_hard_x),
+             (L_trip_batch_all_y, L_trip_batch_hard_y, fraction_easy_y, fraction_semi_y, fraction_hard_y)) = context.triplet_losses(
+                batch_label_x_input, batch_label_y_input, latent, context.triplet_margin, device,
+                chunk_size=context.triplet_chunk_size, metric=context.triplet_metric,
+                normalized=context.normalized_embeddings)
         
-        L_total = lambda_super*(L_trip_batch_all_x + L_trip_batch_all_y) +  lambda_regul*L_weight + L_reconstruction_x + L_reconstruction_y
+        L_total = lambda_super*(L_trip_batch_all_x + L_trip_batch_all_y) +  context.lambda_regul*L_weight + L_reconstruction_x + L_reconstruction_y
         
-        if hard_loss:
-            L_total = lambda_super*(L_trip_batch_hard_x + L_trip_batch_hard_y) +  lambda_regul*L_weight + L_reconstruction_x + L_reconstruction_y
+        if context.hard_loss:
+            L_total = lambda_super*(L_trip_batch_hard_x + L_trip_batch_hard_y) +  context.lambda_regul*L_weight + L_reconstruction_x + L_reconstruction_y
 
         if train == True:
-            optimizer.zero_grad()
-            L_total.backward()
-            optimizer.step()
-
-
-        L_totals.append(L_total.detach().cpu().numpy())
-        L_reconstruction_xs.append(L_reconstruction_x.detach().cpu().numpy())
-        L_reconstruction_ys.append(L_reconstruction_y.detach().cpu().numpy())
-        L_weights.append(L_weight.detach().cpu().numpy())
-        L_trip_batch_hard_xs.append(L_trip_batch_hard_x.detach().cpu().numpy())
-        L_trip_batch_hard_ys.append(L_trip_batch_hard_y.detach().cpu().numpy())
-        L_trip_batch_all_xs.append(L_trip_batch_all_x.detach().cpu().numpy())
-        L_trip_batch_all_ys.append(L_trip_batch_all_y.detach().cpu().numpy())
-        fraction_hard_xs.append(fraction_hard_x.detach().cpu().numpy())
-        fraction_hard_ys.append(fraction_hard_y.detach().cpu().numpy())
-        fraction_semi_xs.append(fraction_semi_x.detach().cpu().numpy())
-        fraction_semi_ys.append(fraction_semi_y.detach().cpu().numpy())
-        fraction_easy_xs.append(fraction_easy_x.detach().cpu().numpy())
-        fraction_easy_ys.append(fraction_easy_y.detach().cpu().numpy())
-        
-    print( train_name+"_epoch:%d\ttotal_loss:%03.5f\treconstruction_loss_x:%03.5f\treconstruction_loss_y:%03.5f\tsparse_penalty:%03.5f\tx_triplet_loss_batch_hard:%03.5f\ty_triplet_loss_batch_hard:%03.5f\tx_triplet_loss_batch_all:%03.5f\ty_triplet_loss_batch_all:%03.5f\tx_fraction_hard:%03.5f\ty_fraction_hard:%03.5f\tx_fraction_semi:%03.5f\ty_fraction_semi:%03.5f\tx_fraction_easy:%03.5f\ty_fraction_easy:%03.5f"
-        % (epoch, np.mean(L_totals), np.mean(L_reconstruction_xs), np.mean(L_reconstruction_ys), np.mean(L_weights), np.mean(L_trip_batch_hard_xs), np.mean(L_trip_batch_hard_ys), np.mean(L_trip_batch_all_xs), np.mean(L_trip_batch_all_ys), np.mean(fraction_hard_xs), np.mean(fraction_hard_ys),  np.mean(fraction_semi_xs), np.mean(fraction_semi_ys), np.mean(fraction_easy_xs), np.mean(fraction_easy_ys)), file = sourceFile)    
-    
+            with stage('backward'):
+                optimizer.zero_grad()
+                L_total.backward()
+            with stage('optimizer_step'):
+                optimizer.step()
+
+
+        metrics.add(L_total, L_reconstruction_x, L_reconstruction_y, L_weight,
+                    L_trip_batch_hard_x, L_trip_batch_hard_y, L_trip_batch_all_x, L_trip_batch_all_y,
+                    fraction_hard_x, fraction_hard_y, fraction_semi_x, fraction_semi_y,
+                    fraction_easy_x, fraction_easy_y)
+
+    # single device -> host transfer per epoch
+    epoch_metrics = metrics.result(train_name, epoch)
+    context.log_epoch(epoch_metrics)
+    if profiler is not None:
+        profiler.end_epoch(train_name, epoch, metrics.n_batches)
+
+    return epoch_metrics
+
+
+def _apply_async_labels(async_clusterer, label_x, label_y, epoch, device, context):
+    # swap in the labels of the pending background clustering and log how stale they are
+    labels, snapshot_epoch, wait = async_clusterer.collect()
+    context.log('cluster_update\tsnapshot_epoch:%d\tapplied_epoch:%d\tstaleness:%d\twait_seconds:%.3f'
+                % (snapshot_epoch, epoch, epoch - snapshot_epoch, wait))
+    context.record('cluster_update', snapshot_epoch=snapshot_epoch, applied_epoch=epoch,
+                   staleness=epoch - snapshot_epoch, wait_seconds=wait)
+    context.emit('recluster_wait', 'async', wait, snapshot_epoch=snapshot_epoch, epoch=epoch)
+    label_x = make_labels(labels['x'], device) if 'x' in labels else label_x
+    label_y = make_labels(labels['y'], device) if 'y' in labels else label_y
+    return label_x, label_y
+
+
+def _to_numpy(data):
+    if isinstance(data, torch.Tensor):
+        return data.detach().cpu().numpy()
+    return np.asarray(data)
+
+
+def cluster_latents(cluster_backend, datasets, device):
+    ''' Cluster {key: tensor} inputs with the backend and return {key: labels} on device.
+    '''
+    if len(datasets) == 0:
+        return {}
+    labels = cluster_backend.cluster_many({key: _to_numpy(data) for key, data in datasets.items()})
+    return {key: make_labels(value, device) for key, value in labels.items()}
 
     
+class PreparedInputs:
+    ''' Inputs of muse_fit_predict after the preprocessing that doesn't depend on the
+        model hyperparameters: opened/converted features, train split and initial labels.
+        Build it once with `prepare_inputs` and pass it as `prepared` to every fit.
+    '''
+    def __init__(self, data_x, data_y, index_names, train_subset, label_x, label_y,
+                 create_label_x, create_label_y, cluster_backend, out_of_core, k):
+        self.data_x = data_x
+        self.data_y = data_y
+        self.index_names = index_names
+        self.train_subset = train_subset
+        self.label_x = label_x
+        self.label_y = label_y
+        self.create_label_x = create_label_x
+        self.create_label_y = create_label_y
+        self.cluster_backend = cluster_backend
+        self.out_of_core = out_of_core
+        self.k = k
+
+    def share_memory(self):
+        ''' Move in-memory CPU tensors to shared memory so spawned workers map them
+            instead of copying.
+        '''
+        for name in ['data_x', 'data_y', 'label_x', 'label_y']:
+            value = getattr(self, name)
+            if isinstance(value, torch.Tensor) and value.device.type == 'cpu':
+                value.share_memory_()
+        return self
+
+
+def prepare_inputs(data_x, data_y, index_names=[], label_x=[], label_y=[], test_subset=[], k=10,
+                   cluster_backend=None, device='cpu', initial_clustering=True, seed=None):
+    ''' Open and convert the inputs, split off the test rows and create the initial
+        cluster labels of the training rows.
+
+    Args:
+        data_x, data_y, index_names, label_x, label_y, test_subset, k, cluster_backend:
+            as in muse_fit_predict
+        device: device the in-memory features and labels are moved to
+        initial_clustering: cluster the inputs that have no labels (skipped on resume)
+        seed: seed of the cluster backend, if it has none of its own
+
+    Return:
+        PreparedInputs
+    '''
+    device = torch.device(device)
+
+    # read data-specific parameters from inputs
+    data_x = open_features(data_x)
+    data_y = open_features(data_y)
+    n_sample = data_x.shape[0]
+
+    # transform in-memory inputs to tensor; memory-mapped / on-disk inputs stay
+    # on the host and only the current minibatch is moved to the device
+    out_of_core = not (is_resident(data_x) and is_resident(data_y))
+    if not out_of_core:
+        transform=ToTensor()
+        data_x = data_x.to(device) if isinstance(data_x, torch.Tensor) else transform(data_x).to(device)
+        data_y = data_y.to(device) if isinstance(data_y, torch.Tensor) else transform(data_y).to(device)
+
+    #index names if none input
+    if len(index_names) == 0:
+        index_names = np.arange(n_sample)
+
+    #remove test subset...
+    train_subset = np.arange(n_sample)
+    train_subset = list(set(train_subset) - set(test_subset))
+
+    #create initial cluster labels if non input - only on training data
+    #labels are kept as cluster ids (or sparse pairs), batch masks are built on the fly
+    if cluster_backend is None:
+        cluster_backend = PhenoGraphBackend(k=k)
+    cluster_backend = cluster_backend.seeded(seed)
+
+    create_label_x = not has_labels(label_x)
+    create_label_y = not has_labels(label_y)
+    if not create_label_x:
+        label_x = subset_labels(make_labels(label_x, device), train_subset)
+    if not create_label_y:
+        label_y = subset_labels(make_labels(label_y, device), train_subset)
+    if initial_clustering:
+        to_cluster = {}
+        if create_label_x:
+            to_cluster['x'] = RowView(data_x, train_subset)
+        if create_label_y:
+            to_cluster['y'] = RowView(data_y, train_subset)
+        new_labels = broadcast_object(cluster_latents(cluster_backend, to_cluster, device) if get_rank() == 0 else None)
+        label_x = new_labels.get('x', label_x)
+        label_y = new_labels.get('y', label_y)
+
+    return PreparedInputs(data_x, data_y, index_names, train_subset, label_x, label_y,
+                          create_label_x, create_label_y, cluster_backend, out_of_core, k)
+
     
 def muse_fit_predict(resultsdir, data_x,
                      data_y,
@@ -126,143 +280,306 @@ def muse_fit_predict(resultsdir, data_x,
                      latent_dim=128,
                      n_epochs=500,
                      lambda_regul=5,
-                     lambda_super=10, triplet_margin=0.1, hard_loss=False, l2_norm = True, k=10, dropout=0.25, save_update_epochs=False):
+                     lambda_super=10, triplet_margin=0.1, hard_loss=False, l2_norm = True, k=10, dropout=0.25, save_update_epochs=False,
+                     triplet_chunk_size=None, cluster_backend=None, async_clustering=False, async_clustering_lag=5,
+                     seed=None, output_format='csv', max_pending_checkpoints=2, checkpoint_every=None, resume_from=None,
+                     inference_chunk_size=4096, device=None, num_threads=None, num_interop_threads=None, n_processes=1,
+                     prepared=None, history=None, n_epochs_init=200, convergence=None, profiler=None,
+                     metrics_format=None, precision='float32', compile_model=False, compile_mode=None,
+                     triplet_metric='cosine', latent_index=None):
     
+    arguments = dict(locals())
     
     # parameter setting for neural network
     n_hidden = 128  # number of hidden node in neural network
     learn_rate = 1e-4  # learning rate in the optimization
-    batch_size = 64  # number of cells in the training batch
-    n_epochs_init = 200
     cluster_update_epoch = 50
-    sourceFile = open('{}.txt'.format(resultsdir), 'w')
+
+    # fail before training on arguments that are only used at the end of the run
+    output_path(resultsdir, output_format)
+    if latent_index is not None and latent_index not in LATENT_INDEX_BACKENDS:
+        raise ValueError('Please choose latent_index from {}!'.format(LATENT_INDEX_BACKENDS))
+
+    # cpu performance: thread pools, and data parallel training over local processes
+    configure_threads(num_threads, num_interop_threads)
+    if n_processes > 1 and not is_distributed():
+        if async_clustering:
+            raise ValueError('async_clustering is not supported with n_processes > 1!')
+        if profiler is not None:
+            raise ValueError('profiler is not supported with n_processes > 1!')
+        if prepared is not None:
+            prepared.share_memory()
+            data_x, data_y = prepared.data_x, prepared.data_y
+        arguments.update(data_x=share_memory(data_x), data_y=share_memory(data_y), history=None)
+        run_distributed(muse_fit_predict, n_processes, arguments, num_threads=num_threads)
+        data_x, data_y = open_features(data_x), open_features(data_y)
+        model = structured_embedding(data_x.shape[1], data_y.shape[1], latent_dim, n_hidden, dropout, l2_norm)
+        model.load_state_dict(torch.load('{}.pth'.format(resultsdir)))
+        return model
+    rank = get_rank()
+    world_size = get_world_size()
+
+    # only the first process writes the log, checkpoints and outputs
+    if rank == 0:
+        sourceFile = open('{}.txt'.format(resultsdir), 'w' if resume_from is None else 'a')
+    else:
+        sourceFile = open(os.devnull, 'w')
     
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+
     # get device
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() and world_size == 1 else "cpu"
+    device = torch.device(device)
     if device.type == "cuda":
         torch.cuda.get_device_name()
         
-    # set globals  (same across all training)
-    globals()['sourceFile'] = sourceFile
-    globals()['lambda_regul'] = lambda_regul
-    globals()['triplet_margin'] = triplet_margin
-    globals()['hard_loss'] = hard_loss
-    globals()['device'] = device
+    # settings of this run, passed to train_model (nothing is stored in module globals,
+    # so several fits can run side by side)
+    # with metrics_format ('jsonl' / 'parquet') every epoch is also written as a structured record
+    metrics_sink = open_metrics_sink(resultsdir, metrics_format, append=resume_from is not None) if rank == 0 else None
+    context = RunContext(sourceFile, device, lambda_regul, triplet_margin, hard_loss, triplet_chunk_size, history,
+                         profiler, metrics_sink, triplet_metric=triplet_metric, normalized_embeddings=l2_norm)
 
-    # read data-specific parameters from inputs
+    # shared preprocessing: reuse the prepared inputs of a sweep or build them here
+    if prepared is None:
+        prepared = prepare_inputs(data_x, data_y, index_names, label_x, label_y, test_subset, k,
+                                  cluster_backend, device, initial_clustering=resume_from is None, seed=seed)
+        cluster_backend = prepared.cluster_backend
+    else:
+        # stateful backends (warm starts) must not carry over between fits
+        cluster_backend = copy.deepcopy(cluster_backend if cluster_backend is not None else prepared.cluster_backend)
+        cluster_backend = cluster_backend.seeded(seed)
+    data_x, data_y = prepared.data_x, prepared.data_y
+    if not prepared.out_of_core and data_x.device != device:
+        data_x, data_y = data_x.to(device), data_y.to(device)
     feature_dim_x = data_x.shape[1]
     feature_dim_y = data_y.shape[1]
-    n_sample = data_x.shape[0]
-          
-    # transform inputs to tensor
-    transform=ToTensor()
-    data_x = transform(data_x).to(device)
-    data_y = transform(data_y).to(device)
-    
-        
-    #index names if none input
-    if len(index_names) == 0:
-        index_names = np.arange(n_sample)
-        
-    #remove test subset...
-    train_subset = np.arange(n_sample)
-    train_subset = list(set(train_subset) - set(test_subset))
-    train_data_x = data_x[train_subset]
-    train_data_y = data_y[train_subset]
-    if len(label_x) > 0 :
-        label_x = label_x[train_subset]
-    if len(label_y) > 0 : 
-        label_y = label_y[train_subset]
-
+    index_names = prepared.index_names
+    out_of_core = prepared.out_of_core
+    train_subset = prepared.train_subset
+    create_label_x, create_label_y = prepared.create_label_x, prepared.create_label_y
+    label_x = labels_to(prepared.label_x, device)
+    label_y = labels_to(prepared.label_y, device)
 
-    #create initial cluster labels if non input - only on training data
-    create_label_x = False
-    if len(label_x) == 0 :
-        label_x, _, _ = phenograph.cluster(train_data_x.detach().cpu().numpy(), k=k, primary_metric='cosine')
-        label_x = transform(make_matrix_from_labels(label_x)).to(device)
-        create_label_x = True
-    else:
-        if (len(label_x.shape) == 1) or (label_x.shape[1] == 1) :
-            label_x = transform(make_matrix_from_labels(label_x)).to(device)
-        else:
-            label_x = transform(label_x).to(device)
-            
-    create_label_y = False
-    if len(label_y) == 0 :
-        label_y, _, _ = phenograph.cluster(train_data_y.detach().cpu().numpy(), k=k, primary_metric='cosine')
-        label_y = transform(make_matrix_from_labels(label_y)).to(device)
-        create_label_y = True
-    else:
-        if (len(label_y.shape) == 1) or (label_y.shape[1] == 1) :
-            label_y = transform(make_matrix_from_labels(label_y)).to(device)
-        else:
-            label_y = transform(label_y).to(device)
+    resume_state = None
+    if resume_from is not None:
+        resume_state = load_training_state(resume_from, device)
+        train_subset = resume_state['train_subset']
+        cluster_backend = resume_state['cluster_backend']
+        create_label_x = resume_state['labels']['create_label_x']
+        create_label_y = resume_state['labels']['create_label_y']
+        label_x = resume_state['labels']['label_x']
+        label_y = resume_state['labels']['label_y']
+    train_data_x = RowView(data_x, train_subset)
+    train_data_y = RowView(data_y, train_subset)
             
     # create model, optimizer, trainloader 
     model = structured_embedding(feature_dim_x, feature_dim_y, latent_dim, n_hidden, dropout, l2_norm).to(device)
+    if rank == 0:
+        # hyperparameters for load_model / transform of new proteins
+        save_model_config(resultsdir, dict(x_input_size=feature_dim_x, y_input_size=feature_dim_y, latent_dim=latent_dim,
+                                           hidden_size=n_hidden, dropout=dropout, l2_norm=l2_norm),
+                          dict(batch_size=batch_size, n_epochs=n_epochs, n_epochs_init=n_epochs_init,
+                               lambda_regul=lambda_regul, lambda_super=lambda_super, triplet_margin=triplet_margin,
+                               hard_loss=hard_loss, k=k, seed=seed, precision=precision, triplet_metric=triplet_metric))
     optimizer = optim.Adam(model.parameters(), lr=learn_rate)
-    train_loader = DataLoader(Protein_Dataset(train_data_x, train_data_y), batch_size=batch_size, shuffle=True)
-
-     #INIT WITH JUST RECONSTRUCTION
-    for epoch in range(n_epochs_init):
-        model.train()
-        train_model(model, optimizer, train_loader, label_x, label_y, epoch, 0, 'init_recon', True, device)
-        
-  #  INIT WITH TRIPLET LOSS AND RECONSTRUCTION, ORIGINAL LABELS
-    for epoch in range(n_epochs_init):
-        model.train()
-        train_model(model, optimizer, train_loader, label_x, label_y, epoch, lambda_super, 'init_both', True, device)
+    loader_seed = 0
+    if world_size > 1:
+        # every process shuffles with the same seed and trains on its own shard
+        loader_seed = broadcast_object(seed if seed is not None else random.randrange(2**31))
+    train_loader = Protein_BatchLoader(train_data_x, train_data_y, batch_size=batch_size, shuffle=True, device=device,
+                                       rank=rank, world_size=world_size, seed=loader_seed)
 
-    latent, reconstruct_x, reconstruct_y, latent_x, latent_y = model(train_data_x, train_data_y) 
-    
+    # init phases train on the input labels, 'train' on the labels of the latent space
+    phases = [('init_recon', n_epochs_init, 0),
+              ('init_both', n_epochs_init, lambda_super),
+              ('train', n_epochs, lambda_super)]
+    phase_index, start_epoch = 0, 0
+    # optional early end of each phase, {phase name: criterion or list of criteria}
+    convergence = convergence if convergence is not None else {}
+    unknown = set(convergence) - set(phase[0] for phase in phases)
+    if len(unknown) > 0:
+        raise ValueError('Unknown phases {} in convergence, use {}!'.format(sorted(unknown), [phase[0] for phase in phases]))
+    criteria = copy.deepcopy({phase[0]: as_criteria(convergence.get(phase[0])) for phase in phases})
     update_label_x = label_x
     update_label_y = label_y
-    if create_label_x:
-        update_label_x, _, _ = phenograph.cluster(latent_x.detach().cpu().numpy(), k=k , primary_metric='cosine')
-        update_label_x = transform(make_matrix_from_labels(update_label_x)).to(device)
-    if create_label_y:
-        update_label_y, _, _ = phenograph.cluster(latent_y.detach().cpu().numpy(), k=k , primary_metric='cosine')
-        update_label_y = transform(make_matrix_from_labels(update_label_y)).to(device)
+
+    if resume_state is not None:
+        model.load_state_dict(resume_state['model'])
+        optimizer.load_state_dict(resume_state['optimizer'])
+        update_label_x = resume_state['labels']['update_label_x']
+        update_label_y = resume_state['labels']['update_label_y']
+        phase_index = [phase[0] for phase in phases].index(resume_state['phase'])
+        start_epoch = resume_state['epoch']
+        if resume_state.get('convergence') is not None:
+            criteria = resume_state['convergence']
+        set_rng_state(resume_state['rng'])
+
+    # gradients are averaged across processes, everything else uses the plain model
+    train_net = DistributedDataParallel(model) if world_size > 1 else model
+
+    # opt-in mixed precision / compiled training step; inference and exports keep the float32 eager model
+    context.autocast_dtype = autocast_dtype(precision)
+    if compile_model:
+        train_net, context.triplet_losses = compile_training_step(train_net, compile_mode, triplet_chunk_size)
+    if context.autocast_dtype is not None or compile_model:
+        # compare with the eager float32 path on the first training rows (no RNG is consumed)
+        items = np.arange(min(batch_size, len(train_subset)))
+        check = check_execution_mode(model, gather_rows(train_data_x, items, device), gather_rows(train_data_y, items, device),
+                                     batch_labels(update_label_x, items), batch_labels(update_label_y, items), precision,
+                                     train_net if compile_model else None, context.triplet_losses, triplet_margin, device,
+                                     metric=triplet_metric, normalized=l2_norm, chunk_size=triplet_chunk_size)
+        context.log('precision_check\tprecision:%s\tcompile:%s\tlatent_max_abs_diff:%.5f\tloss_max_rel_diff:%.5f\tok:%s'
+                    % (precision, compile_model, check['latent_max_abs_diff'], check['loss_max_rel_diff'], check['ok']))
+        context.record('precision_check', precision=precision, compile=compile_model, **check)
+        if not check['ok']:
+            warnings.warn('{} / compile={} differs from float32 beyond tolerance: {}'.format(precision, compile_model, check))
+
+    checkpoint_writer = CheckpointWriter(max_pending_checkpoints)
+    async_clusterer = None
+    if async_clustering and (create_label_x or create_label_y):
+        if seed is not None and not cluster_backend.deterministic:
+            # e.g. phenograph's Louvain, which cannot be seeded
+            warnings.warn('async_clustering with {} is not deterministic given the seed; use '
+                          'PhenoGraphBackend(clustering_algo="leiden") or WarmLeidenBackend for '
+                          'reproducible label swaps'.format(type(cluster_backend).__name__))
+        async_clusterer = AsyncClusterer(cluster_backend, async_clustering_lag)
+        if resume_state is not None and resume_state['pending_clustering'] is not None:
+            async_clusterer.submit(*resume_state['pending_clustering'])
+
+    if profiler is not None:
+        profiler.start_trace()
+    for phase_index in range(phase_index, len(phases)):
+        train_name, n_phase_epochs, phase_lambda_super = phases[phase_index]
+        phase_offset = sum(phase[1] for phase in phases[:phase_index])
+        phase_section = context.begin('phase', train_name, start_epoch=start_epoch)
+
+        if train_name == 'train' and start_epoch == 0:
+            # move from the input labels to the clusters of the initialized latent space
+            new_labels = None
+            if rank == 0:
+                # resident inputs keep the original full-batch train-mode forward; on-disk
+                # inputs can't be passed at once and use chunked (eval-mode) inference
+                if out_of_core:
+                    embedded = embed(model, train_data_x, train_data_y, inference_chunk_size, ['latent_x', 'latent_y'])
+                    latent_x, latent_y = embedded['latent_x'], embedded['latent_y']
+                else:
+                    latent, reconstruct_x, reconstruct_y, latent_x, latent_y = model(train_data_x[:], train_data_y[:]) 
     
-    # TRAIN WITH LABELS
-    for epoch in range(n_epochs):
-        model.train()
-        train_model(model, optimizer, train_loader, update_label_x, update_label_y, epoch, lambda_super, 'train', True, device)
+                to_cluster = {}
+                if create_label_x:
+                    to_cluster['x'] = latent_x
+                if create_label_y:
+                    to_cluster['y'] = latent_y
+                with context.section('recluster', 'transition', epoch=0):
+                    new_labels = cluster_latents(cluster_backend, to_cluster, device)
+            new_labels = broadcast_object(new_labels)
+            update_label_x = new_labels.get('x', label_x)
+            update_label_y = new_labels.get('y', label_y)
+
+        trigger = None
+        for epoch in range(start_epoch, n_phase_epochs):
+            previous_labels = dict(x=update_label_x, y=update_label_y)
+            if async_clusterer is not None and async_clusterer.ready(epoch):
+                update_label_x, update_label_y = _apply_async_labels(async_clusterer, update_label_x, update_label_y,
+                                                                     epoch, device, context)
+            train_loader.set_epoch(phase_offset + epoch)
+            train_net.train()
+            epoch_metrics = train_model(train_net, optimizer, train_loader, update_label_x, update_label_y, epoch,
+                                        phase_lambda_super, train_name, True, device, context)
+            trigger = check_epoch(criteria[train_name], epoch_metrics)
         
-        if epoch%cluster_update_epoch == 0:
-            model.eval()
-            with torch.no_grad():
-                latent, reconstruct_x, reconstruct_y, latent_x, latent_y = model(data_x, data_y)   
-
-            if save_update_epochs:
-                torch.save(model.state_dict(), '{}_{}.pth'.format(resultsdir, epoch))
-                pd.DataFrame(latent.detach().cpu().numpy(), index = index_names).to_csv('{}_latent_{}.txt'.format(resultsdir, epoch))
-                pd.DataFrame(reconstruct_x.detach().cpu().numpy(), index = index_names).to_csv('{}_reconstruct_x_{}.txt'.format(resultsdir, epoch))
-                pd.DataFrame(reconstruct_y.detach().cpu().numpy(), index = index_names).to_csv('{}_reconstruct_y_{}.txt'.format(resultsdir, epoch))
-                pd.DataFrame(latent_x.detach().cpu().numpy(), index = index_names).to_csv('{}_latent_x_{}.txt'.format(resultsdir, epoch))
-                pd.DataFrame(latent_y.detach().cpu().numpy(), index = index_names).to_csv('{}_latent_y_{}.txt'.format(resultsdir, epoch))
+            if train_name == 'train' and epoch%cluster_update_epoch == 0 and rank == 0:
+                # chunked inference; decoders only run when the outputs are saved
+                embedded = embed(model, data_x, data_y, inference_chunk_size,
+                                 OUTPUT_NAMES if save_update_epochs else ['latent_x', 'latent_y'])
+
+                if save_update_epochs:
+                    # snapshot here, serialize on the writer thread
+                    checkpoint_writer.submit(context.timed('checkpoint', 'model', torch.save, epoch=epoch),
+                                             snapshot_state_dict(model), '{}_{}.pth'.format(resultsdir, epoch))
+                    checkpoint_writer.submit(context.timed('output', output_format, save_outputs, epoch=epoch),
+                                             resultsdir, embedded, index_names, output_format, suffix='_{}'.format(epoch))
             
-            # update clusters (only on training data)
-            if create_label_x:
-                train_latent_x = latent_x[train_subset]
-                update_label_x, _, _ = phenograph.cluster(train_latent_x.detach().cpu().numpy(), k=k , primary_metric='cosine')
-                update_label_x = transform(make_matrix_from_labels(update_label_x)).to(device)
-            if create_label_y:
-                train_latent_y = latent_y[train_subset]
-                update_label_y, _, _ = phenograph.cluster(train_latent_y.detach().cpu().numpy(), k=k , primary_metric='cosine')
-                update_label_y = transform(make_matrix_from_labels(update_label_y)).to(device)
+                # update clusters (only on training data)
+                to_cluster = {}
+                if create_label_x:
+                    to_cluster['x'] = embedded['latent_x'][train_subset]
+                if create_label_y:
+                    to_cluster['y'] = embedded['latent_y'][train_subset]
+                if async_clusterer is not None:
+                    # snapshot now, keep training on the current labels until the swap epoch
+                    if async_clusterer.pending:
+                        update_label_x, update_label_y = _apply_async_labels(async_clusterer, update_label_x, update_label_y,
+                                                                             epoch, device, context)
+                    async_clusterer.submit(to_cluster, epoch)
+                else:
+                    with context.section('recluster', 'update', epoch=epoch):
+                        new_labels = cluster_latents(cluster_backend, to_cluster, device)
+                    update_label_x = new_labels.get('x', update_label_x)
+                    update_label_y = new_labels.get('y', update_label_y)
+
+            if world_size > 1 and train_name == 'train' and epoch%cluster_update_epoch == 0:
+                update_label_x, update_label_y = broadcast_object((update_label_x, update_label_y))
+            # the labels of the other processes are fresh copies from broadcast_object, so the
+            # first process decides on cluster convergence and every process follows it
+            cluster_trigger = None
+            if rank == 0:
+                cluster_trigger = check_clusters(criteria[train_name], previous_labels, dict(x=update_label_x, y=update_label_y))
+            if world_size > 1:
+                cluster_trigger = broadcast_object(cluster_trigger)
+            # metrics are averaged, so the epoch criteria agree on every process
+            trigger = cluster_trigger or trigger
+
+            if checkpoint_every and (epoch + 1) % checkpoint_every == 0 and rank == 0:
+                pending_clustering = None
+                if async_clusterer is not None and async_clusterer.pending:
+                    pending_clustering = (async_clusterer.datasets, async_clusterer.snapshot_epoch)
+                state = snapshot_training_state(train_name, n_phase_epochs if trigger else epoch + 1, model, optimizer,
+                                                dict(label_x=label_x, label_y=label_y,
+                                                     update_label_x=update_label_x, update_label_y=update_label_y,
+                                                     create_label_x=create_label_x, create_label_y=create_label_y),
+                                                train_subset,
+                                                async_clusterer.backend if async_clusterer is not None else cluster_backend,
+                                                pending_clustering, criteria)
+                checkpoint_writer.submit(context.timed('checkpoint', 'state', save_training_state, epoch=epoch),
+                                         state, '{}_state.pt'.format(resultsdir))
+                # everything up to the checkpoint survives an interruption
+                context.flush()
+            if trigger:
+                break
+        if start_epoch < n_phase_epochs:
+            context.log_transition(train_name, epoch + 1, trigger or 'max_epochs')
+            context.end(phase_section, epochs=epoch + 1 - start_epoch, trigger=trigger or 'max_epochs')
+        start_epoch = 0
+    if profiler is not None:
+        profiler.stop_trace()
+
+    if async_clusterer is not None:
+        async_clusterer.close()
                            
     #SAVE FINAL RESULTS
-    model.eval()
-    with torch.no_grad():
-        latent, reconstruct_x, reconstruct_y, latent_x, latent_y = model(data_x, data_y)
-    
-    torch.save(model.state_dict(), '{}.pth'.format(resultsdir))
-    pd.DataFrame(latent.detach().cpu().numpy(), index = index_names).to_csv('{}_latent.txt'.format(resultsdir))
-    pd.DataFrame(reconstruct_x.detach().cpu().numpy(), index = index_names).to_csv('{}_reconstruct_x.txt'.format(resultsdir))
-    pd.DataFrame(reconstruct_y.detach().cpu().numpy(), index = index_names).to_csv('{}_reconstruct_y.txt'.format(resultsdir))
-    pd.DataFrame(latent_x.detach().cpu().numpy(), index = index_names).to_csv('{}_latent_x.txt'.format(resultsdir))
-    pd.DataFrame(latent_y.detach().cpu().numpy(), index = index_names).to_csv('{}_latent_y.txt'.format(resultsdir))
-    sourceFile.close()
+    if rank == 0:
+        checkpoint_writer.submit(context.timed('checkpoint', 'model', torch.save), snapshot_state_dict(model),
+                                 '{}.pth'.format(resultsdir))
+        if output_format == 'npy':
+            # stream the chunks straight into the memory-mapped store
+            with context.section('output', output_format):
+                outputs = embed(model, data_x, data_y, inference_chunk_size, out=output_path(resultsdir, output_format), index_names=index_names)
+        else:
+            outputs = embed(model, data_x, data_y, inference_chunk_size)
+            checkpoint_writer.submit(context.timed('output', output_format, save_outputs), resultsdir,
+                                     outputs, index_names, output_format)
+        # top-k cosine index of the final latents, saved as '{resultsdir}_latent_index'
+        if latent_index is not None:
+            with context.section('output', 'latent_index'):
+                build_latent_index(resultsdir, latent=outputs['latent'], index_names=index_names, backend=latent_index)
+    # all outputs are complete once close() returns
+    checkpoint_writer.close()
+    context.close()
     
     return model
\ No newline at end of file
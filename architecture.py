@@ -1,4 +1,5 @@
 ### Classes used for coembedding 
+import json
 import torch
 import random
 import numpy as np
@@ -12,6 +13,8 @@ from torch.utils.data import DataLoader, Dataset
 from sklearn.metrics.pairwise import euclidean_distances, cosine_similarity
 from sklearn.metrics.pairwise import manhattan_distances, euclidean_distances, cosine_similarity
 from .triplet_loss import batch_hard_triplet_loss
+from .file_utils import OUTPUT_NAMES, create_output_store
+from .data_utils import gather_rows
 
 def cos_sim(A, B):
         cosine = np.dot(A,B)/(norm(A)*norm(B))
@@ -34,6 +37,65 @@ class Protein_Dataset(Dataset):
     def __getitem__(self, item):
         return self.data_train_x[item], self.data_train_y[item], item
 
+
+class Protein_BatchLoader:
+    ''' Batched replacement for DataLoader(Protein_Dataset(...)).
+
+    Each epoch draws one shuffled permutation and yields (batch_x, batch_y, items),
+    where every batch is read with a single gather and items are row indices
+    on the training device, ready for the label lookup. The data can be resident
+    tensors, RowView subsets or out-of-core arrays (np.memmap, h5py, zarr), in
+    which case only the batch is converted to float32 and moved to the device.
+
+    With world_size > 1 every process draws the same permutation from
+    (seed, epoch), set with set_epoch(), and keeps its own equal-sized shard
+    (padded by wrapping around, as DistributedSampler does).
+    '''
+    def __init__(self, data_train_x, data_train_y, batch_size, shuffle=True, drop_last=False, device=None,
+                 rank=0, world_size=1, seed=0):
+        self.data_train_x = data_train_x
+        self.data_train_y = data_train_y
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        if device is None:
+            device = getattr(data_train_x, 'device', torch.device('cpu'))
+        self.device = device
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _n_items(self):
+        return math.ceil(len(self.data_train_x) / self.world_size)
+
+    def __len__(self):
+        if self.drop_last:
+            return self._n_items() // self.batch_size
+        return math.ceil(self._n_items() / self.batch_size)
+
+    def _order(self):
+        n = len(self.data_train_x)
+        if self.world_size == 1:
+            return torch.randperm(n) if self.shuffle else torch.arange(n)
+        if self.shuffle:
+            order = torch.randperm(n, generator=torch.Generator().manual_seed(self.seed + self.epoch))
+        else:
+            order = torch.arange(n)
+        padding = self._n_items() * self.world_size - n
+        order = torch.cat([order, order[:padding]])
+        return order[self.rank::self.world_size]
+
+    def __iter__(self):
+        order = self._order().to(self.device)
+        for step in range(len(self)):
+            items = order[step*self.batch_size:(step+1)*self.batch_size]
+            yield (gather_rows(self.data_train_x, items, self.device),
+                   gather_rows(self.data_train_y, items, self.device), items)
+
 def init_weights(m):
     if type(m) == nn.Linear:
         nn.init.xavier_normal_(m.weight.data)
@@ -102,7 +164,7 @@ class structured_embedding(nn.Module):
         self.decoder_y.apply(init_weights)
                
     
-    def forward(self, x, y):
+    def encode(self, x, y):
         
         h_x = self.encoder_x(x)
         h_y = self.encoder_y(y)
@@ -114,14 +176,141 @@ class structured_embedding(nn.Module):
         if self.l2_norm:
             z = nn.functional.normalize(z, p=2, dim=1)
 
+        return z, h_x, h_y
+
+    def decode(self, z):
+
         z_x = self.decoder_h_x(z)
         z_y = self.decoder_h_y(z)
         
         x_hat = self.decoder_x(z_x)
         y_hat = self.decoder_y(z_y)
 
+        return x_hat, y_hat
+
+    def forward(self, x, y):
+
+        z, h_x, h_y = self.encode(x, y)
+        x_hat, y_hat = self.decode(z)
 
         return z, x_hat, y_hat, h_x, h_y
+
+
+def embed(model, data_x, data_y, chunk_size=4096, outputs=OUTPUT_NAMES, out=None, index_names=None):
+    ''' Run a structured_embedding over the data in fixed-size chunks (eval mode, no_grad).
+
+    Args:
+        model: structured_embedding
+        data_x, data_y: (N, features) arrays or tensors, any array-like that can be
+            sliced by rows (e.g. np.memmap); only one chunk is moved to the device at a time
+        chunk_size: number of rows per forward pass
+        outputs: names (subset of OUTPUT_NAMES) to compute; the decoders only
+            run if a reconstruction is requested
+        out: optional dict {name: preallocated (N, dim) array}, or the path of an
+            npy output store (see `create_output_store`), written chunk by chunk
+        index_names: row names saved with the store when out is a path
+
+    Return:
+        dict {name: float32 numpy array} (memory-mapped when out is a path)
+    '''
+    unknown = set(outputs) - set(OUTPUT_NAMES)
+    if unknown:
+        raise ValueError('Unknown outputs {}, select from {}!'.format(sorted(unknown), OUTPUT_NAMES))
+    device = next(model.parameters()).device
+    n = len(data_x)
+    decode = 'reconstruct_x' in outputs or 'reconstruct_y' in outputs
+
+    was_training = model.training
+    model.eval()
+    results = out if isinstance(out, dict) else {}
+    if isinstance(out, str) and index_names is not None:
+        create_output_store(out, {}, index_names)
+    with torch.no_grad():
+        # an empty input still runs one (0-row) chunk, which gives the (0, dim) outputs
+        for start in range(0, n, chunk_size) or [0]:
+            x = _chunk_to_tensor(data_x[start:start+chunk_size], device)
+            y = _chunk_to_tensor(data_y[start:start+chunk_size], device)
+            z, h_x, h_y = model.encode(x, y)
+            values = dict(latent=z, latent_x=h_x, latent_y=h_y)
+            if decode:
+                values['reconstruct_x'], values['reconstruct_y'] = model.decode(z)
+            for name in outputs:
+                value = values[name].float().cpu().numpy()
+                if name not in results:
+                    if isinstance(out, str):
+                        results.update(create_output_store(out, {name: (n, value.shape[1])}))
+                    else:
+                        results[name] = np.empty((n, value.shape[1]), dtype=np.float32)
+                results[name][start:start+len(value)] = value
+    model.train(was_training)
+    return {name: results[name] for name in outputs}
+
+def model_config_path(resultsdir):
+    ''' Location of the hyperparameters of a run, written next to '{resultsdir}.pth'.
+    '''
+    return '{}_config.json'.format(resultsdir)
+
+def save_model_config(resultsdir, model_config, fit_config=None):
+    ''' Write the structured_embedding arguments (and optionally the fit
+        hyperparameters) of a run as JSON, so `load_model` can rebuild the model.
+
+    Args:
+        resultsdir: prefix of the run outputs
+        model_config: dict of structured_embedding arguments (x_input_size,
+            y_input_size, latent_dim, hidden_size, dropout, l2_norm)
+        fit_config: optional dict of further hyperparameters, kept for reference
+    '''
+    with open(model_config_path(resultsdir), 'w') as f:
+        json.dump(dict(model=model_config, fit=fit_config if fit_config is not None else {}), f, indent=2)
+
+def load_model(resultsdir, epoch=None, device='cpu'):
+    ''' Rebuild a fitted structured_embedding from '{resultsdir}.pth' and '{resultsdir}_config.json'.
+
+    Args:
+        resultsdir: prefix of the run outputs
+        epoch: load the checkpoint of this update epoch ('{resultsdir}_{epoch}.pth')
+            instead of the final model
+        device: device of the model
+
+    Return:
+        structured_embedding in eval mode
+    '''
+    with open(model_config_path(resultsdir)) as f:
+        config = json.load(f)
+    model = structured_embedding(**config['model'])
+    fname = '{}.pth'.format(resultsdir) if epoch is None else '{}_{}.pth'.format(resultsdir, epoch)
+    model.load_state_dict(torch.load(fname, map_location=device))
+    return model.to(device).eval()
+
+def transform(model, data_x, data_y, chunk_size=4096, reconstruct=False, out=None, index_names=None):
+    ''' Embed new proteins with a fitted model, without retraining.
+
+    Args:
+        model: structured_embedding, e.g. from `load_model`
+        data_x, data_y: (N, features) arrays, tensors or memmaps with the feature
+            columns of the training data, in the same order
+        chunk_size: number of rows per forward pass
+        reconstruct: also return reconstruct_x and reconstruct_y
+        out, index_names: write into an npy output store, as in `embed`
+
+    Return:
+        dict {name: float32 numpy array} of latent, latent_x, latent_y (and the
+        reconstructions)
+    '''
+    if len(data_x) != len(data_y):
+        raise ValueError('data_x and data_y have {} and {} rows!'.format(len(data_x), len(data_y)))
+    for name, data, layer in [('data_x', data_x, model.encoder_x[1]), ('data_y', data_y, model.encoder_y[1])]:
+        if data.shape[1] != layer.in_features:
+            raise ValueError('{} has {} features, the model expects {}!'.format(name, data.shape[1], layer.in_features))
+    outputs = ['latent', 'latent_x', 'latent_y'] + (['reconstruct_x', 'reconstruct_y'] if reconstruct else [])
+    return embed(model, data_x, data_y, chunk_size, outputs, out, index_names)
+
+def _chunk_to_tensor(chunk, device):
+    if isinstance(chunk, torch.Tensor):
+        return chunk.to(device=device, dtype=torch.float32)
+    # a copy: slices of read-only memmaps / h5 / zarr arrays are not writable, which
+    # torch.from_numpy warns about
+    return torch.as_tensor(np.array(chunk, dtype=np.float32)).to(device)
         
         
         
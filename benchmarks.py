@@ -0,0 +1,282 @@
+### Throughput benchmarks on synthetic data, results as JSON to track regressions
+import os
+import json
+import time
+import platform
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+import torch.optim as optim
+
+from .architecture import structured_embedding, Protein_BatchLoader
+from .triplet_loss import paired_triplet_losses
+from .clustering import PhenoGraphBackend, WarmLeidenBackend
+from .file_utils import save_outputs
+from .run_context import RunContext
+from .profiling import peak_rss_mb, current_rss_mb
+from .df_utils import pairwise_similarity
+
+
+def make_synthetic_data(n_samples=1000, dim_x=1024, dim_y=512, n_clusters=20, noise=1.0, seed=0):
+    ''' Clustered two-modality data, e.g. stand-ins for image and interaction features.
+
+    Every cluster has a random centre in each modality; samples are their
+    cluster centre plus gaussian noise.
+
+    Args:
+        n_samples: number of proteins
+        dim_x, dim_y: feature dimensions of the two modalities
+        n_clusters: number of clusters shared by both modalities
+        noise: standard deviation of the noise around the centres
+        seed: random seed
+
+    Return:
+        data_x (n_samples, dim_x), data_y (n_samples, dim_y) float32 arrays and
+        the cluster ids (n_samples,)
+    '''
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(0, n_clusters, n_samples)
+    centres_x = rng.normal(size=(n_clusters, dim_x)).astype(np.float32)
+    centres_y = rng.normal(size=(n_clusters, dim_y)).astype(np.float32)
+    data_x = centres_x[labels] + noise * rng.standard_normal((n_samples, dim_x), dtype=np.float32)
+    data_y = centres_y[labels] + noise * rng.standard_normal((n_samples, dim_y), dtype=np.float32)
+    return data_x, data_y, labels
+
+
+def time_it(fn, repeat=5, warmup=1, device=None):
+    ''' Run fn warmup + repeat times and return the wall times of the timed runs.
+    '''
+    sync = torch.cuda.synchronize if device is not None and torch.device(device).type == 'cuda' else (lambda: None)
+    for _ in range(warmup):
+        fn()
+    sync()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        sync()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def _result(name, times, steps=1, **params):
+    # one JSON record: median / min wall time and throughput (memory is added by _run_measured)
+    median = float(np.median(times))
+    return dict(name=name, params=params, repeat=len(times), seconds=median, min_seconds=float(np.min(times)),
+                steps_per_sec=steps / median if median > 0 else float('inf'))
+
+
+def _run_measured(run, args):
+    # run one benchmark and add its memory use; ru_maxrss is the high-water mark of the
+    # whole process, so peak_rss_mb is per benchmark only when each runs in a fresh process
+    cuda = torch.cuda.is_available()
+    if cuda:
+        torch.cuda.reset_peak_memory_stats()
+    baseline = current_rss_mb()
+    result = run(*args)
+    result.update(baseline_rss_mb=baseline, peak_rss_mb=peak_rss_mb())
+    if cuda:
+        result['cuda_peak_mb'] = torch.cuda.max_memory_allocated() / 2**20
+    return result
+
+
+def _run_isolated(run, args):
+    # a spawned single-use worker: no memory high-water mark inherited from earlier benchmarks
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(_run_measured, run, args).result()
+
+
+def benchmark_triplet_loss(batch_size=64, latent_dim=128, n_clusters=20, chunk_size=None, metric='cosine',
+                           normalized=True, repeat=20, device='cpu'):
+    ''' Forward and backward of the triplet losses of one training step (x and y labels).
+    '''
+    rng = np.random.default_rng(0)
+    latent = torch.nn.functional.normalize(torch.randn(batch_size, latent_dim, device=device)).requires_grad_()
+    label_x = torch.from_numpy(rng.integers(0, n_clusters, batch_size)).to(device)
+    label_y = torch.from_numpy(rng.integers(0, n_clusters, batch_size)).to(device)
+
+    def step():
+        loss_x, loss_y = paired_triplet_losses(label_x, label_y, latent, 0.1, device, chunk_size, metric, normalized)
+        (loss_x[0] + loss_y[0]).backward()
+
+    return _result('triplet_loss', time_it(step, repeat, device=device), batch_size=batch_size,
+                   latent_dim=latent_dim, n_clusters=n_clusters, chunk_size=chunk_size, metric=metric,
+                   normalized=normalized, device=str(device))
+
+
+def benchmark_forward_backward(batch_size=64, dim_x=1024, dim_y=512, latent_dim=128, n_hidden=128, repeat=20, device='cpu'):
+    ''' Forward, reconstruction loss, backward and optimizer step of structured_embedding.
+    '''
+    model = structured_embedding(dim_x, dim_y, latent_dim, n_hidden, 0.25, True).to(device)
+    optimizer = optim.Adam(model.parameters(), lr=1e-4)
+    x = torch.randn(batch_size, dim_x, device=device)
+    y = torch.randn(batch_size, dim_y, device=device)
+    model.train()
+
+    def step():
+        latent, reconstruct_x, reconstruct_y, latent_x, latent_y = model(x, y)
+        loss = torch.norm(reconstruct_x - x) + torch.norm(reconstruct_y - y)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    return _result('forward_backward', time_it(step, repeat, device=device), batch_size=batch_size, dim_x=dim_x,
+                   dim_y=dim_y, latent_dim=latent_dim, n_hidden=n_hidden, device=str(device))
+
+
+def benchmark_train_epoch(data_x, data_y, labels, batch_size=64, latent_dim=128, repeat=3, device='cpu'):
+    ''' One train_model epoch over the data; steps are minibatches.
+    '''
+    from . import train_model
+    model = structured_embedding(data_x.shape[1], data_y.shape[1], latent_dim, 128, 0.25, True).to(device)
+    optimizer = optim.Adam(model.parameters(), lr=1e-4)
+    data_x = torch.from_numpy(data_x).to(device)
+    data_y = torch.from_numpy(data_y).to(device)
+    labels = torch.from_numpy(labels).to(device)
+    loader = Protein_BatchLoader(data_x, data_y, batch_size=batch_size, shuffle=True, device=device)
+    with open(os.devnull, 'w') as log_file:
+        context = RunContext(log_file, torch.device(device))
+        times = time_it(lambda: train_model(model, optimizer, loader, labels, labels, 0, 10, 'train', True,
+                                            torch.device(device), context), repeat, device=device)
+    return _result('train_epoch', times, steps=len(loader), n_samples=len(labels), dim_x=data_x.shape[1],
+                   dim_y=data_y.shape[1], batch_size=batch_size, latent_dim=latent_dim, device=str(device))
+
+
+def benchmark_make_matrix(labels, repeat=5):
+    ''' Dense co-cluster matrix of the labels (numpy path of make_matrix_from_labels).
+    '''
+    from . import make_matrix_from_labels
+    return _result('make_matrix_from_labels', time_it(lambda: make_matrix_from_labels(labels), repeat),
+                   n_samples=len(labels))
+
+
+def benchmark_recluster(latent, backend, name, repeat=3):
+    ''' Clustering of latent embeddings; stateful backends are timed warm (after the first call).
+    '''
+    return _result(name, time_it(lambda: backend.cluster(latent, 'x'), repeat), n_samples=latent.shape[0],
+                   latent_dim=latent.shape[1], k=backend.k)
+
+
+def benchmark_output_writing(n_samples=1000, dim_x=1024, dim_y=512, latent_dim=128, output_format='csv', repeat=3):
+    ''' save_outputs of the five output arrays in the given format.
+    '''
+    rng = np.random.default_rng(0)
+    outputs = dict(latent=rng.standard_normal((n_samples, latent_dim), dtype=np.float32),
+                   reconstruct_x=rng.standard_normal((n_samples, dim_x), dtype=np.float32),
+                   reconstruct_y=rng.standard_normal((n_samples, dim_y), dtype=np.float32),
+                   latent_x=rng.standard_normal((n_samples, latent_dim), dtype=np.float32),
+                   latent_y=rng.standard_normal((n_samples, latent_dim), dtype=np.float32))
+    with tempfile.TemporaryDirectory() as tmp:
+        resultsdir = os.path.join(tmp, 'bench')
+        times = time_it(lambda: save_outputs(resultsdir, outputs, np.arange(n_samples), output_format), repeat, warmup=0)
+    return _result('save_outputs_' + output_format, times, n_samples=n_samples, dim_x=dim_x, dim_y=dim_y,
+                   latent_dim=latent_dim)
+
+
+def benchmark_correlation(n_rows=1000, n_features=64, method='pearson', repeat=3, reference_rows=None,
+                          memory_budget=256 * 2**20):
+    ''' Scaled correlation similarity of the rows: pairwise_similarity against pandas' DataFrame.corr.
+
+    Args:
+        reference_rows: time pandas on the first reference_rows rows only (its
+            kendall is a python loop over the row pairs); its time for all rows is
+            extrapolated by the number of row pairs. None: all rows
+        memory_budget: memory budget of pairwise_similarity
+    '''
+    import pandas as pd
+    df = pd.DataFrame(make_synthetic_data(n_rows, n_features, 1, seed=2)[0])
+    reference_df = df if reference_rows is None else df.iloc[:reference_rows]
+
+    def pandas_scaled():
+        corr = reference_df.T.corr(method=method)
+        corr = corr - corr.min().min()
+        return corr / corr.max().max()
+
+    reference = pandas_scaled()
+    pandas_times = time_it(pandas_scaled, repeat, warmup=0)
+    times = time_it(lambda: pairwise_similarity(df, method, memory_budget=memory_budget), repeat)
+    result = _result('correlation_' + method, times, n_rows=n_rows, n_features=n_features, memory_budget=memory_budget)
+    result['pandas_rows'] = len(reference_df)
+    result['pandas_seconds'] = float(np.median(pandas_times)) * (n_rows / len(reference_df))**2
+    result['pandas_extrapolated'] = len(reference_df) < n_rows
+    result['speedup'] = result['pandas_seconds'] / result['seconds']
+    result['max_abs_diff'] = float(np.abs(pairwise_similarity(reference_df, method, memory_budget=memory_budget).values
+                                          - reference.values).max())
+    return result
+
+
+def run_benchmarks(n_samples=2000, dim_x=1024, dim_y=512, n_clusters=20, batch_size=64, latent_dim=128, k=10,
+                   repeat=5, device='cpu', output=None, include=None, isolate=True):
+    ''' Run the benchmark suite on synthetic data.
+
+    Args:
+        n_samples, dim_x, dim_y, n_clusters: size of the synthetic data
+        batch_size, latent_dim, k: training / clustering settings
+        repeat: timed repetitions per benchmark
+        device: torch device of the training benchmarks
+        output: optional path of the JSON report
+        include: optional list of benchmark names to run (default: all)
+        isolate: run every benchmark in its own process, so that peak_rss_mb (and
+            cuda_peak_mb) are the memory high-water marks of that benchmark alone;
+            without it peak_rss_mb is the high-water mark of the process so far
+
+    Return:
+        dict with the environment ('meta') and one record per benchmark ('results');
+        each record has baseline_rss_mb, the resident memory before the benchmark
+        started (imports and inputs), and peak_rss_mb
+    '''
+    data_x, data_y, labels = make_synthetic_data(n_samples, dim_x, dim_y, n_clusters)
+    latent = make_synthetic_data(n_samples, latent_dim, 1, n_clusters, seed=1)[0]
+    # (name, function, arguments): picklable, so that each can run in a spawned process
+    benchmarks = [
+        ('triplet_loss', benchmark_triplet_loss, (batch_size, latent_dim, n_clusters, None, 'cosine', True, repeat * 4,
+                                                  device)),
+        ('forward_backward', benchmark_forward_backward, (batch_size, dim_x, dim_y, latent_dim, 128, repeat * 4,
+                                                          device)),
+        ('train_epoch', benchmark_train_epoch, (data_x, data_y, labels, batch_size, latent_dim, repeat, device)),
+        ('make_matrix_from_labels', benchmark_make_matrix, (labels, repeat)),
+        ('recluster_phenograph', benchmark_recluster, (latent, PhenoGraphBackend(k=k), 'recluster_phenograph', repeat)),
+        ('recluster_warm_leiden', benchmark_recluster, (latent, WarmLeidenBackend(k=k, seed=0), 'recluster_warm_leiden',
+                                                        repeat)),
+        ('save_outputs_csv', benchmark_output_writing, (n_samples, dim_x, dim_y, latent_dim, 'csv', repeat)),
+        ('save_outputs_npy', benchmark_output_writing, (n_samples, dim_x, dim_y, latent_dim, 'npy', repeat)),
+        ('correlation_pearson', benchmark_correlation, (n_samples, 64, 'pearson', repeat)),
+        ('correlation_spearman', benchmark_correlation, (n_samples, 64, 'spearman', repeat)),
+        # expression-profile sized rows; pandas' kendall (a python loop over the row pairs) is
+        # timed on 100 rows and extrapolated
+        ('correlation_kendall', benchmark_correlation, (n_samples, 512, 'kendall', repeat, min(n_samples, 100))),
+    ]
+    measure = _run_isolated if isolate else _run_measured
+    results = [measure(run, args) for name, run, args in benchmarks if include is None or name in include]
+
+    report = dict(meta=dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'), python=platform.python_version(),
+                            platform=platform.platform(), torch=torch.__version__, numpy=np.__version__,
+                            num_threads=torch.get_num_threads(), cpu_count=os.cpu_count()),
+                  results=results)
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='MUSE throughput benchmarks on synthetic data')
+    parser.add_argument('--n-samples', type=int, default=2000)
+    parser.add_argument('--dim-x', type=int, default=1024)
+    parser.add_argument('--dim-y', type=int, default=512)
+    parser.add_argument('--n-clusters', type=int, default=20)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--latent-dim', type=int, default=128)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--include', nargs='*')
+    parser.add_argument('--output', default='benchmarks.json')
+    parser.add_argument('--no-isolate', dest='isolate', action='store_false',
+                        help='run all benchmarks in this process (peak_rss_mb is then process-wide)')
+    args = parser.parse_args()
+    run_benchmarks(args.n_samples, args.dim_x, args.dim_y, args.n_clusters, args.batch_size, args.latent_dim,
+                   repeat=args.repeat, device=args.device, output=args.output, include=args.include,
+                   isolate=args.isolate)
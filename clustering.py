@@ -0,0 +1,276 @@
+### Re-clustering backends used to (re)build the cluster labels during training
+import numpy as np
+import scipy.sparse as sp
+import phenograph
+import leidenalg
+import igraph as ig
+import copy
+import time
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+def sort_by_size(communities, min_cluster_size=10):
+    ''' Relabel communities 0..n-1 by decreasing size; communities smaller than
+        min_cluster_size become -1 (same convention as phenograph).
+    '''
+    communities = np.asarray(communities)
+    ids, inverse, counts = np.unique(communities, return_inverse=True, return_counts=True)
+    order = np.argsort(-counts, kind='stable')
+    rank = np.empty(len(ids), dtype=np.int64)
+    rank[order] = np.arange(len(ids))
+    rank[counts < min_cluster_size] = -1
+    return rank[inverse]
+
+
+def exact_cosine_knn(data, k, block_size=None):
+    ''' k nearest neighbours (self excluded) by cosine similarity, computed with
+        blocked matrix products.
+
+    Return:
+        (N, k) int array of neighbour indices, most similar first
+    '''
+    x = _unit_rows(data)
+    n = len(x)
+    if block_size is None:
+        block_size = max(1, min(n, 2**24 // max(n, 1)))
+    idx = np.empty((n, k), dtype=np.int64)
+    for start in range(0, n, block_size):
+        sims = x[start:start+block_size] @ x.T
+        rows = np.arange(len(sims))
+        sims[rows, start + rows] = -np.inf
+        idx[start:start+block_size] = _top_k(sims, np.broadcast_to(np.arange(n), sims.shape), k)
+    return idx
+
+
+def refine_cosine_knn(data, idx, block_size=1024):
+    ''' One NN-descent step: re-rank the previous neighbours and the neighbours
+        of neighbours against the new data. Cost is O(N k^2 d) instead of O(N^2 d).
+
+    Args:
+        data: (N, d) data matrix
+        idx: (N, k) neighbour indices from a previous (exact or refined) graph
+
+    Return:
+        (N, k) int array of neighbour indices, most similar first
+    '''
+    x = _unit_rows(data)
+    n, k = idx.shape
+    refined = np.empty_like(idx)
+    for start in range(0, n, block_size):
+        block = idx[start:start+block_size]
+        rows = np.arange(start, start + len(block))
+        candidates = np.sort(np.concatenate([block, idx[block].reshape(len(block), k*k)], axis=1), axis=1)
+        sims = np.einsum('bd,bcd->bc', x[rows], x[candidates])
+        # drop self matches and repeated candidates
+        duplicate = np.zeros(candidates.shape, dtype=bool)
+        duplicate[:, 1:] = candidates[:, 1:] == candidates[:, :-1]
+        sims[duplicate | (candidates == rows[:, None])] = -np.inf
+        refined[start:start+block_size] = _top_k(sims, candidates, k)
+    return refined
+
+
+def jaccard_graph(idx):
+    ''' Symmetric Jaccard-weighted kNN graph as built by phenograph
+        (lower triangle, COO), computed with one sparse product.
+    '''
+    n, k = idx.shape
+    rows = np.repeat(np.arange(n), k)
+    cols = idx.reshape(-1)
+    A = sp.csr_matrix((np.ones(n*k, dtype=np.float32), (rows, cols)), shape=(n, n))
+    shared = np.asarray((A @ A.T)[rows, cols]).reshape(-1)
+    graph = sp.coo_matrix((shared / (2*k - shared), (rows, cols)), shape=(n, n))
+    return sp.tril((graph + graph.transpose()).multiply(0.5), -1).tocoo()
+
+
+def _unit_rows(data):
+    x = np.asarray(data, dtype=np.float32)
+    norm = np.linalg.norm(x, axis=1, keepdims=True)
+    return x / np.maximum(norm, 1e-8)
+
+
+def _top_k(sims, candidates, k):
+    top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+    top_sims = np.take_along_axis(sims, top, axis=1)
+    top = np.take_along_axis(top, np.argsort(-top_sims, axis=1, kind='stable'), axis=1)
+    return np.take_along_axis(np.asarray(candidates), top, axis=1)
+
+
+class ClusterBackend:
+    ''' Interface for re-clustering backends.
+
+    cluster(data, key) returns integer labels for the rows of data; key names
+    the stream being clustered (e.g. 'x' or 'y') so stateful backends can reuse
+    work from the previous call on the same key.
+    '''
+    def cluster(self, data, key=None):
+        raise NotImplementedError
+
+    def cluster_many(self, datasets):
+        ''' Cluster several {key: data} inputs, returns {key: labels}.
+        '''
+        return {key: self.cluster(data, key) for key, data in datasets.items()}
+
+    # True if repeated calls on the same data give the same labels
+    deterministic = False
+
+    def seeded(self, seed):
+        ''' Backend using seed for its random choices, unless it already has a seed
+            (a copy; self is not modified).
+        '''
+        return self
+
+
+class PhenoGraphBackend(ClusterBackend):
+    ''' Reference backend: phenograph.cluster from scratch with cosine kNN.
+    '''
+    def __init__(self, k=10, primary_metric='cosine', **kwargs):
+        self.k = k
+        self.primary_metric = primary_metric
+        self.kwargs = kwargs
+
+    def cluster(self, data, key=None):
+        labels, _, _ = phenograph.cluster(data, k=self.k, primary_metric=self.primary_metric, **self.kwargs)
+        return labels
+
+    @property
+    def deterministic(self):
+        # phenograph's default Louvain binary ignores the seed, its Leiden honours it
+        return self.kwargs.get('clustering_algo') == 'leiden' and self.kwargs.get('seed') is not None
+
+    def seeded(self, seed):
+        if seed is None or self.kwargs.get('seed') is not None:
+            return self
+        backend = copy.copy(self)
+        backend.kwargs = dict(self.kwargs, seed=seed)
+        return backend
+
+
+class WarmLeidenBackend(ClusterBackend):
+    ''' Incremental backend: the kNN graph of each key is refined from the previous
+        update (exact rebuild every rebuild_every updates), and Leiden is
+        warm-started from the previous partition. cluster_many() runs the keys
+        in parallel threads.
+
+    Args:
+        k: number of neighbours
+        rebuild_every: exact kNN rebuild period, in updates
+        resolution_parameter: resolution of the RBConfiguration partition
+        n_iterations: Leiden iterations (-1 runs until stable)
+        min_cluster_size: smaller clusters are labelled -1, as in phenograph
+        seed: Leiden seed
+        n_jobs: number of keys clustered concurrently
+    '''
+    def __init__(self, k=10, rebuild_every=5, resolution_parameter=1, n_iterations=-1,
+                 min_cluster_size=10, seed=None, n_jobs=2):
+        self.k = k
+        self.rebuild_every = rebuild_every
+        self.resolution_parameter = resolution_parameter
+        self.n_iterations = n_iterations
+        self.min_cluster_size = min_cluster_size
+        self.seed = seed
+        self.n_jobs = n_jobs
+        self.state = {}
+
+    @property
+    def deterministic(self):
+        return self.seed is not None
+
+    def seeded(self, seed):
+        if seed is None or self.seed is not None:
+            return self
+        # warm-start state is per backend, not shared with the copy
+        backend = copy.deepcopy(self)
+        backend.seed = seed
+        return backend
+
+    def cluster(self, data, key=None):
+        state = self.state.get(key)
+        if state is not None and state['n'] != len(data):
+            state = None
+
+        # neighbour graph: refine the previous one while the feature space is unchanged
+        if state is None or state['dim'] != data.shape[1] or state['since_rebuild'] + 1 >= self.rebuild_every:
+            idx = exact_cosine_knn(data, self.k)
+            since_rebuild = 0
+        else:
+            idx = refine_cosine_knn(data, state['idx'])
+            since_rebuild = state['since_rebuild'] + 1
+        graph = jaccard_graph(idx)
+
+        g = ig.Graph(n=len(data), edges=np.vstack([graph.row, graph.col]).T.tolist())
+        partition = leidenalg.find_partition(g, leidenalg.RBConfigurationVertexPartition,
+                                             initial_membership=None if state is None else state['membership'],
+                                             weights=graph.data.astype('float64'),
+                                             n_iterations=self.n_iterations, seed=self.seed,
+                                             resolution_parameter=self.resolution_parameter)
+        membership = list(partition.membership)
+
+        self.state[key] = dict(n=len(data), dim=data.shape[1], idx=idx, membership=membership,
+                               since_rebuild=since_rebuild)
+        return sort_by_size(membership, self.min_cluster_size)
+
+    def cluster_many(self, datasets):
+        if self.n_jobs == 1 or len(datasets) == 1:
+            return super().cluster_many(datasets)
+        with ThreadPoolExecutor(max_workers=self.n_jobs) as pool:
+            futures = {key: pool.submit(self.cluster, data, key) for key, data in datasets.items()}
+            return {key: future.result() for key, future in futures.items()}
+
+
+def _cluster_job(backend, datasets):
+    # runs in the worker process; the backend comes back so its state survives
+    return backend.cluster_many(datasets), backend
+
+
+class AsyncClusterer:
+    ''' Runs backend.cluster_many on latent snapshots in a background worker process.
+
+    Labels computed from the snapshot taken at epoch e are handed back at epoch
+    e + lag, waiting for the worker if it is not done yet. Fixing the swap epoch
+    (rather than swapping whenever the worker finishes) keeps runs deterministic
+    for a seeded backend.
+
+    Args:
+        backend: a ClusterBackend, must be picklable
+        lag: number of training epochs run on the previous labels
+    '''
+    def __init__(self, backend, lag):
+        self.backend = backend
+        self.lag = lag
+        self.executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+        self.future = None
+        self.datasets = None
+        self.snapshot_epoch = None
+
+    @property
+    def pending(self):
+        return self.future is not None
+
+    def submit(self, datasets, epoch):
+        ''' Start clustering {key: numpy array} snapshots taken at `epoch`.
+        '''
+        self.future = self.executor.submit(_cluster_job, self.backend, datasets)
+        self.datasets = datasets
+        self.snapshot_epoch = epoch
+
+    def ready(self, epoch):
+        return self.pending and epoch >= self.snapshot_epoch + self.lag
+
+    def collect(self):
+        ''' Wait for the pending job.
+
+        Return:
+            ({key: labels}, snapshot epoch, seconds spent waiting)
+        '''
+        tic = time.time()
+        labels, self.backend = self.future.result()
+        wait = time.time() - tic
+        snapshot_epoch = self.snapshot_epoch
+        self.future = None
+        self.datasets = None
+        self.snapshot_epoch = None
+        return labels, snapshot_epoch, wait
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
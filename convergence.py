@@ -0,0 +1,122 @@
+### Convergence criteria that end a training phase before its maximum number of epochs
+import numpy as np
+import torch
+from sklearn.metrics import adjusted_rand_score, normalized_mutual_info_score
+
+FRACTION_NAMES = ['x_fraction_hard', 'y_fraction_hard',
+                  'x_fraction_semi', 'y_fraction_semi',
+                  'x_fraction_easy', 'y_fraction_easy']
+
+
+class ConvergenceCriterion:
+    ''' Interface for phase convergence criteria.
+
+    update() sees the EpochMetrics of every epoch, update_clusters() every new
+    partition of the latent space, as {key: labels} of the inputs that changed.
+    Both return a short description of the trigger once the phase has converged,
+    else None.
+    '''
+    def update(self, epoch_metrics):
+        return None
+
+    def update_clusters(self, previous, labels):
+        return None
+
+
+class LossPlateau(ConvergenceCriterion):
+    ''' Converged when a loss has not improved by more than min_delta (relative to
+        the best value so far) for `patience` epochs.
+    '''
+    def __init__(self, metric='total_loss', patience=10, min_delta=1e-3):
+        self.metric = metric
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best = np.inf
+        self.since_best = 0
+
+    def update(self, epoch_metrics):
+        value = epoch_metrics[self.metric]
+        if self.best == np.inf or value < self.best - self.min_delta * abs(self.best):
+            self.best = value
+            self.since_best = 0
+            return None
+        self.since_best += 1
+        if self.since_best >= self.patience:
+            return 'loss_plateau(%s=%.5f)' % (self.metric, self.best)
+        return None
+
+
+class ClusterStability(ConvergenceCriterion):
+    ''' Converged when `patience` consecutive cluster updates of every clustered
+        input agree with the previous partition (ARI or NMI >= threshold).
+        Pairwise label matrices are not compared.
+    '''
+    def __init__(self, score='ari', threshold=0.95, patience=2):
+        if score not in ('ari', 'nmi'):
+            raise ValueError('Please choose score "ari" or "nmi"!')
+        self.score = score
+        self.threshold = threshold
+        self.patience = patience
+        self.scores = {}
+
+    def update_clusters(self, previous, labels):
+        score = adjusted_rand_score if self.score == 'ari' else normalized_mutual_info_score
+        for key in labels:
+            if isinstance(previous[key], torch.Tensor) and isinstance(labels[key], torch.Tensor):
+                value = score(previous[key].cpu().numpy(), labels[key].cpu().numpy())
+                self.scores.setdefault(key, []).append(value)
+        if len(self.scores) == 0:
+            return None
+        recent = [scores[-self.patience:] for scores in self.scores.values()]
+        if all(len(scores) >= self.patience and min(scores) >= self.threshold for scores in recent):
+            return 'cluster_stability(%s>=%.3f)' % (self.score, self.threshold)
+        return None
+
+
+class FractionStability(ConvergenceCriterion):
+    ''' Converged when no triplet fraction (hard / semi-hard / easy, x and y) moved
+        by more than `tolerance` over the last `patience` epochs.
+    '''
+    def __init__(self, tolerance=0.01, patience=10, metrics=FRACTION_NAMES):
+        self.tolerance = tolerance
+        self.patience = patience
+        self.metrics = list(metrics)
+        self.window = []
+
+    def update(self, epoch_metrics):
+        self.window = (self.window + [[epoch_metrics[name] for name in self.metrics]])[-(self.patience + 1):]
+        if len(self.window) <= self.patience:
+            return None
+        window = np.asarray(self.window)
+        if np.all(window.max(axis=0) - window.min(axis=0) <= self.tolerance):
+            return 'fraction_stability(tolerance=%.4f)' % self.tolerance
+        return None
+
+
+def as_criteria(criteria):
+    ''' Normalize a criterion, a list of criteria or None to a list.
+    '''
+    if criteria is None:
+        return []
+    if isinstance(criteria, ConvergenceCriterion):
+        return [criteria]
+    return list(criteria)
+
+
+def check_epoch(criteria, epoch_metrics):
+    ''' Feed one epoch to every criterion; returns the first trigger or None.
+    '''
+    triggers = [criterion.update(epoch_metrics) for criterion in criteria]
+    return next((trigger for trigger in triggers if trigger is not None), None)
+
+
+def check_clusters(criteria, previous, labels):
+    ''' Feed the partitions of {key: labels} that differ from `previous` to every
+        criterion; returns the first trigger or None.
+    '''
+    changed = [key for key in labels if labels[key] is not previous[key]]
+    if len(changed) == 0:
+        return None
+    previous, labels = {key: previous[key] for key in changed}, {key: labels[key] for key in changed}
+    triggers = [criterion.update_clusters(previous, labels) for criterion in criteria]
+    return next((trigger for trigger in triggers if trigger is not None), None)
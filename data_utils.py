@@ -0,0 +1,102 @@
+### Input sources for muse_fit_predict: in-memory tensors or out-of-core arrays
+import numpy as np
+import torch
+
+
+def open_features(source):
+    ''' Open a feature matrix without reading it into memory.
+
+    Args:
+        source: array-like (returned as is), or a path:
+            '*.npy': memory-mapped with np.load(mmap_mode='r')
+            '*.h5' / '*.hdf5', optionally 'file.h5:dataset': h5py dataset (needs h5py);
+                without a dataset name the file must hold a single dataset
+            '*.zarr': zarr array (needs zarr)
+
+    Return:
+        array-like with .shape that can be sliced by rows
+    '''
+    if not isinstance(source, str):
+        return source
+    path, _, key = source.partition(':')
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    elif path.endswith(('.h5', '.hdf5')):
+        import h5py
+        f = h5py.File(path, 'r')
+        if not key:
+            keys = list(f.keys())
+            if len(keys) != 1:
+                raise ValueError('{} holds datasets {}, select one with "{}:<dataset>"!'.format(path, keys, path))
+            key = keys[0]
+        return f[key]
+    elif path.endswith('.zarr'):
+        import zarr
+        return zarr.open(path, mode='r')
+    else:
+        raise ValueError('Please give features as an array or a .npy, .h5/.hdf5 or .zarr path!')
+
+
+def is_resident(data):
+    ''' True for in-memory arrays/tensors that can be moved to the device as a whole.
+    '''
+    if isinstance(data, torch.Tensor):
+        return True
+    return isinstance(data, np.ndarray) and not isinstance(data, np.memmap)
+
+
+def gather_rows(data, items, device):
+    ''' Read rows `items` of an array-like and return them as a float32 tensor on device.
+    '''
+    if isinstance(data, RowView):
+        return data.gather(items, device)
+    if isinstance(data, torch.Tensor):
+        items = torch.as_tensor(items, device=data.device)
+        return data.index_select(0, items).to(device=device, dtype=torch.float32)
+    items = np.asarray(torch.as_tensor(items).cpu())
+    if isinstance(data, np.ndarray):
+        rows = data[items]
+    else:
+        # h5py/zarr want increasing indices: read sorted, then restore the order
+        order = np.argsort(items, kind='stable')
+        rows = np.empty((len(items),) + tuple(data.shape[1:]), dtype=data.dtype)
+        rows[order] = data[items[order]]
+    return torch.from_numpy(np.asarray(rows, dtype=np.float32)).to(device)
+
+
+class RowView:
+    ''' Zero-copy view of a subset of rows (e.g. the training split) of a tensor or
+        array-like. Indexing with local row numbers reads from the underlying data.
+    '''
+    def __init__(self, data, rows):
+        self.data = data
+        self.rows = np.asarray(rows, dtype=np.int64)
+        if isinstance(data, torch.Tensor):
+            self._rows = torch.from_numpy(self.rows).to(data.device)
+        else:
+            self._rows = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def shape(self):
+        return (len(self.rows),) + tuple(self.data.shape[1:])
+
+    @property
+    def device(self):
+        return self.data.device if isinstance(self.data, torch.Tensor) else torch.device('cpu')
+
+    def gather(self, items, device):
+        if self._rows is not None:
+            return gather_rows(self.data, self._rows[torch.as_tensor(items, device=self._rows.device)], device)
+        return gather_rows(self.data, self.rows[np.asarray(torch.as_tensor(items).cpu())], device)
+
+    def __getitem__(self, items):
+        if isinstance(items, slice):
+            items = np.arange(len(self.rows))[items]
+        return self.gather(items, self.device)
+
+    def __array__(self, dtype=None, copy=None):
+        values = self.gather(np.arange(len(self.rows)), torch.device('cpu')).numpy()
+        return values if dtype is None else values.astype(dtype)
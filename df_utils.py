@@ -2,20 +2,145 @@ import numpy as np
 import pandas as pd
 import sys
 import os
-from sklearn.metrics.pairwise import manhattan_distances, euclidean_distances, cosine_similarity
-from scipy.spatial.distance import canberra
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from sklearn.metrics.pairwise import manhattan_distances, euclidean_distances
+from scipy.spatial.distance import cdist
+from scipy.stats import rankdata
 
-def upper_tri_values(df):
+# metrics of pairwise_similarity; distances are turned into similarities by max-minus
+SIMILARITY_METRICS = ['cosine', 'pearson', 'spearman', 'kendall']
+DISTANCE_METRICS = ['manhattan', 'euclidean', 'canberra']
+
+def upper_tri_values(df, memory_budget=256 * 2**20):
     ''' Return array with values of upper triangle of the DataFrame.
     
     Args:
-        df: Symmetric DataFrame
+        df: Symmetric DataFrame (or array / np.memmap)
+        memory_budget: approximate bytes of the row blocks read at a time
     
     Return:
         Numpy array
     '''
-    m = df.values
-    return m[np.triu_indices(df.shape[0], k=1)]
+    # filled chunk by chunk, without the N^2 / 2 triu_indices index arrays
+    n = df.shape[0]
+    values = np.empty(n * (n - 1) // 2, dtype=_matrix_values(df).dtype)
+    position = 0
+    for chunk in iter_upper_tri(df, memory_budget):
+        values[position:position + len(chunk)] = chunk
+        position += len(chunk)
+    return values
+
+def _matrix_values(m):
+    # the numpy (or memory mapped) values of a DataFrame / array, without a copy
+    return m.values if isinstance(m, pd.DataFrame) else m
+
+def _upper_tri_blocks(n, itemsize, memory_budget):
+    # row blocks of at most ~memory_budget bytes of full rows
+    block_size = int(max(1, min(n, memory_budget // (itemsize * max(n, 1)))))
+    return [(start, min(start + block_size, n)) for start in range(0, n, block_size)]
+
+def _upper_tri_chunk(m, start, stop):
+    # values right of the diagonal of rows start:stop, in np.triu_indices order
+    block = np.asarray(m[start:stop, start + 1:])
+    return block[np.arange(block.shape[1])[None, :] >= np.arange(stop - start)[:, None]]
+
+def iter_upper_tri(df, memory_budget=256 * 2**20):
+    ''' Iterate over the values of the upper triangle (k=1) in row blocks.
+
+    Chunks come in the order of upper_tri_values, so concatenating them gives
+    the same array. Only one block of rows is read at a time, which keeps the
+    memory bounded for np.memmap matrices (e.g. from pairwise_similarity(out=...)).
+
+    Args:
+        df: Symmetric DataFrame, array or np.memmap
+        memory_budget: approximate bytes of the row blocks read at a time
+
+    Return:
+        generator of 1D numpy arrays
+    '''
+    m = _matrix_values(df)
+    for start, stop in _upper_tri_blocks(m.shape[0], m.dtype.itemsize, memory_budget):
+        yield _upper_tri_chunk(m, start, stop)
+
+def iter_upper_tri_pairs(df_a, df_b, memory_budget=256 * 2**20):
+    ''' Iterate over aligned upper triangle chunks of two matrices of the same shape.
+
+    Rows and columns are matched by position; reindex DataFrames to the same
+    order first.
+
+    Return:
+        generator of (chunk_a, chunk_b) tuples
+    '''
+    a, b = _matrix_values(df_a), _matrix_values(df_b)
+    if a.shape != b.shape:
+        raise ValueError('Matrices of shape {} and {} cannot be compared!'.format(a.shape, b.shape))
+    # the budget is shared by the two blocks
+    itemsize = a.dtype.itemsize + b.dtype.itemsize
+    for start, stop in _upper_tri_blocks(a.shape[0], itemsize, memory_budget):
+        yield _upper_tri_chunk(a, start, stop), _upper_tri_chunk(b, start, stop)
+
+def upper_tri_correlation(df_a, df_b, memory_budget=256 * 2**20):
+    ''' Pearson correlation between the upper triangle values of two matrices,
+        e.g. latent similarities against a reference network, computed chunk by chunk.
+
+    Pairs where either value is NaN are skipped. Chunk statistics (count, means,
+    sums of squared deviations and co-deviations) are merged with the pairwise
+    update of Chan et al., which is as accurate as the two-pass formula.
+
+    Args:
+        df_a, df_b: Symmetric DataFrames / arrays / np.memmaps of the same shape
+        memory_budget: approximate bytes of the row blocks read at a time
+
+    Return:
+        dict of pearson (the correlation) and n (number of value pairs)
+    '''
+    count, mean_a, mean_b, m2_a, m2_b, co = 0, 0., 0., 0., 0., 0.
+    for chunk_a, chunk_b in iter_upper_tri_pairs(df_a, df_b, memory_budget):
+        keep = ~(np.isnan(chunk_a) | np.isnan(chunk_b))
+        chunk_a, chunk_b = chunk_a[keep].astype(np.float64), chunk_b[keep].astype(np.float64)
+        chunk_count = len(chunk_a)
+        if chunk_count == 0:
+            continue
+        chunk_mean_a, chunk_mean_b = chunk_a.mean(), chunk_b.mean()
+        dev_a, dev_b = chunk_a - chunk_mean_a, chunk_b - chunk_mean_b
+        total = count + chunk_count
+        delta_a, delta_b = chunk_mean_a - mean_a, chunk_mean_b - mean_b
+        weight = count * chunk_count / total
+        m2_a += np.dot(dev_a, dev_a) + delta_a * delta_a * weight
+        m2_b += np.dot(dev_b, dev_b) + delta_b * delta_b * weight
+        co += np.dot(dev_a, dev_b) + delta_a * delta_b * weight
+        mean_a += delta_a * chunk_count / total
+        mean_b += delta_b * chunk_count / total
+        count = total
+    pearson = co / np.sqrt(m2_a * m2_b) if m2_a > 0 and m2_b > 0 else np.nan
+    return dict(pearson=float(pearson), n=count)
+
+def upper_tri_histogram(df, bins=100, range=None, memory_budget=256 * 2**20):
+    ''' Histogram of the upper triangle values, accumulated chunk by chunk.
+
+    Args:
+        df: Symmetric DataFrame, array or np.memmap
+        bins: number of equal-width bins
+        range: (min, max) of the bins; None runs an extra pass for the finite
+            minimum and maximum. NaN and values outside the range are not counted
+        memory_budget: approximate bytes of the row blocks read at a time
+
+    Return:
+        counts, bin edges (as np.histogram)
+    '''
+    if range is None:
+        low, high = np.inf, -np.inf
+        for chunk in iter_upper_tri(df, memory_budget):
+            chunk = chunk[np.isfinite(chunk)]
+            if len(chunk) > 0:
+                low, high = min(low, chunk.min()), max(high, chunk.max())
+        range = (low, high) if low <= high else (0., 1.)
+    edges = np.histogram_bin_edges([], bins=bins, range=range)
+    counts = np.zeros(len(edges) - 1, dtype=np.int64)
+    for chunk in iter_upper_tri(df, memory_budget):
+        counts += np.histogram(chunk[~np.isnan(chunk)], bins=edges)[0]
+    return counts, edges
 
 def znorm(df):
     ''' Z-transform within each column.
@@ -27,96 +152,289 @@ def znorm(df):
     return norm_df
 
 
-def cosine_similarity_scaled(df):
+def cosine_similarity_scaled(df, **kwargs):
     ''' Calculate Cosine similarity between each pair of rows in a DataFrame.
         Similarity scaled into [0, 1]
+        kwargs: options of pairwise_similarity (n_jobs, memory_budget, out, ...)
     '''
-    sim = cosine_similarity(df)
-    shift = sim.min()
-    sim -= shift
-    scale = sim.max()
-    sim /= scale
-    return pd.DataFrame(sim, index=df.index.values, columns=df.index.values)
+    return pairwise_similarity(df, 'cosine', **kwargs)
 
 
-def manhattan_similarity(df):
+def manhattan_similarity(df, **kwargs):
     ''' Calculate Manhattan similarity between each pair of rows in a DataFrame.
         Similarity scaled into [0, 1]
+        kwargs: options of pairwise_similarity (n_jobs, memory_budget, out, ...)
     '''
-    # Get manhattan distance
-    dist = manhattan_distances(df)
-    # Convert distance to similarity by max-minus
-    sim = dist.max() - dist
-    # Scale into [0,1]
-    sim /= sim.max()
-    return pd.DataFrame(sim, index=df.index.values, columns=df.index.values)
+    # distance converted to similarity by max-minus, then scaled into [0,1]
+    return pairwise_similarity(df, 'manhattan', **kwargs)
 
-def euclidean_similarity(df):
+def euclidean_similarity(df, **kwargs):
     ''' Calculate Euclidean similarity between each pair of rows in a DataFrame.
         Similarity scaled into [0, 1]
+        kwargs: options of pairwise_similarity (n_jobs, memory_budget, out, ...)
     '''
-    # Get euclidean distance
-    dist = euclidean_distances(df)
-    # Convert distance to similarity by max-minus
-    sim = dist.max() - dist
-    # Scale into [0,1]
-    sim /= sim.max()
-    return pd.DataFrame(sim, index=df.index.values, columns=df.index.values)
+    return pairwise_similarity(df, 'euclidean', **kwargs)
 
-def canberra_similarity(df):
+def canberra_similarity(df, **kwargs):
     ''' Calculate Canberra similarity between each pair of rows in a DataFrame.
         Similarity scaled into [0, 1]
+        kwargs: options of pairwise_similarity (n_jobs, memory_budget, out, ...)
     '''
-    index = df.index.values
-    dist = pd.DataFrame(0, index=index, columns=index, dtype=float)
-    for i in range(len(index)-1):
-        a = df.loc[index[i]].values
-        for j in range(i+1, len(index)):
-            b = df.loc[index[j]].values
-            d = canberra(a, b)
-            dist.at[index[i], index[j]] = d
-            dist.at[index[j], index[i]] = d
-    dist = dist.values
-    # Convert distance to similarity by max-minus
-    sim = dist.max() - dist
-    # Scale into [0,1]
-    sim /= sim.max()
-    return pd.DataFrame(sim, index=index, columns=index)
-
-def pearson_scaled(df):
+    # vectorized scipy cdist per row block instead of a python loop over pairs
+    return pairwise_similarity(df, 'canberra', **kwargs)
+
+def pearson_scaled(df, **kwargs):
     ''' Calculate Pearson correlation between each pair of rows in a DataFrame.
         Correlation scaled into [0, 1]
+        kwargs: options of pairwise_similarity (n_jobs, memory_budget, out, ...)
     '''
-    corr = df.T.corr(method='pearson')
-    shift = corr.min().min()
-    corr -= shift
-    scale = corr.max().max()
-    corr /= scale
-    return corr
+    # centred unit rows and one matmul per row block (pandas if values are missing)
+    return pairwise_similarity(df, 'pearson', **kwargs)
 
-def spearman_scaled(df):
+def spearman_scaled(df, **kwargs):
     ''' Calculate Spearman correlation between each pair of rows in a DataFrame.
         Correlation scaled into [0, 1]
+        kwargs: options of pairwise_similarity (n_jobs, memory_budget, out, ...)
     '''
-    corr = df.T.corr(method='spearman')
-    shift = corr.min().min()
-    corr -= shift
-    scale = corr.max().max()
-    corr /= scale
-    return corr
+    # Pearson of the within-row ranks
+    return pairwise_similarity(df, 'spearman', **kwargs)
 
-def kendall_scaled(df):
+def kendall_scaled(df, **kwargs):
     ''' Calculate Kendall correlation between each pair of rows in a DataFrame.
         Correlation scaled into [0, 1]
+        kwargs: options of pairwise_similarity (n_jobs, memory_budget, out, ...)
     '''
-    corr = df.T.corr(method='kendall')
-    shift = corr.min().min()
-    corr -= shift
-    scale = corr.max().max()
-    corr /= scale
-    return corr
+    # tau-b as the cosine of the feature-pair sign vectors, accumulated over
+    # feature-pair chunks that fit the memory budget
+    return pairwise_similarity(df, 'kendall', **kwargs)
 
-def check_symmetric(a, rtol=1e-05, atol=1e-08):
+def check_symmetric(a, rtol=1e-05, atol=1e-08, memory_budget=256 * 2**20):
     ''' Check if the given numpy matrix is symmetric or not.
+        Compared in row blocks against the matching column blocks, so no
+        transposed copy of the matrix is made (np.memmap matrices stay on disk).
     '''
-    return np.allclose(a, a.T, rtol=rtol, atol=atol)
+    a = _matrix_values(a)
+    if a.ndim != 2 or a.shape[0] != a.shape[1]:
+        return False
+    for start, stop in _upper_tri_blocks(a.shape[0], 2 * a.dtype.itemsize, memory_budget):
+        if not np.allclose(a[start:stop, start:], a[start:, start:stop].T, rtol=rtol, atol=atol):
+            return False
+    return True
+
+
+def _pair_signs(values, anchors):
+    ''' Sign vectors of the feature pairs (a, b > a) with a in anchors, for every row:
+        s = sign(x[b] - x[a]). Kendall's tau-b of two rows is the cosine of their
+        full sign vectors (ties are 0 and drop out of the norm), so the dot products
+        of all rows can be accumulated chunk of anchors by chunk of anchors.
+    '''
+    n, m = values.shape
+    signs = np.empty((n, sum(m - a - 1 for a in anchors)), dtype=np.float32)
+    start = 0
+    for a in anchors:
+        signs[:, start:start + m - a - 1] = np.sign(values[:, a + 1:] - values[:, a:a + 1])
+        start += m - a - 1
+    return signs
+
+
+def _pair_sign_chunks(n, m, memory_budget):
+    # anchor ranges whose sign vectors of all n rows take about half the memory budget;
+    # at most 2^24 pairs each, so the float32 dot products of a chunk stay exact
+    max_pairs = int(max(m - 1, min(2**24, memory_budget // (2 * 4 * max(n, 1)))))
+    chunks, anchors, pairs = [], [], 0
+    for a in range(m - 1):
+        if pairs + m - a - 1 > max_pairs and len(anchors) > 0:
+            chunks.append(anchors)
+            anchors, pairs = [], 0
+        anchors.append(a)
+        pairs += m - a - 1
+    return chunks + ([anchors] if len(anchors) > 0 else [])
+
+
+def _kendall_norms(values):
+    # norm of the full sign vector of every row: sqrt of the number of untied
+    # feature pairs, from the tie runs of the sorted row (O(m log m) per row)
+    n, m = values.shape
+    ordered = np.sort(values, axis=1)
+    positions = np.broadcast_to(np.arange(m), (n, m))
+    run_start = np.maximum.accumulate(np.where(np.diff(ordered, axis=1, prepend=np.nan) != 0, positions, 0), axis=1)
+    tied = np.sum(positions - run_start, axis=1)
+    return np.sqrt(m * (m - 1) / 2 - tied)
+
+
+def _prepare_rows(values, metric, memory_budget=256 * 2**20):
+    ''' Per-row preprocessing shared by all blocks: unit rows for cosine, centred
+        unit rows for pearson (of the ranks for spearman), and for kendall the rows
+        with their sign vector norms and the feature-pair chunks of the blocks.
+    '''
+    values = np.asarray(values, dtype=float)
+    if metric == 'kendall':
+        return values, _kendall_norms(values), _pair_sign_chunks(values.shape[0], values.shape[1], memory_budget)
+    if metric == 'spearman':
+        values = rankdata(values, axis=1)
+    if metric in ('pearson', 'spearman'):
+        values = values - values.mean(axis=1, keepdims=True)
+    if metric in ('cosine', 'pearson', 'spearman'):
+        norm = np.sqrt(np.sum(np.square(values), axis=1, keepdims=True))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # zero rows: cosine 0 like sklearn, correlation NaN like pandas
+            values = values / (np.where(norm > 0, norm, 1) if metric == 'cosine' else norm)
+    return values
+
+
+def _pairwise_block(values, start, stop, metric):
+    ''' Raw similarities / distances of rows start:stop against all rows.
+    '''
+    rows = np.arange(start, stop)
+    if metric == 'precomputed':
+        return values[start:stop]
+    block = values[start:stop] if metric != 'kendall' else None
+    if metric in ('cosine', 'pearson', 'spearman'):
+        result = block @ values.T
+        if metric != 'cosine':
+            result = np.clip(result, -1, 1)
+            # exact 1 on the diagonal, as pandas
+            result[rows - start, rows] = np.where(np.isnan(result[rows - start, rows]), np.nan, 1.)
+        return result
+    if metric in DISTANCE_METRICS:
+        if metric == 'manhattan':
+            result = manhattan_distances(block, values)
+        elif metric == 'euclidean':
+            result = euclidean_distances(block, values)
+        else:
+            result = cdist(block, values, 'canberra')
+        # exact 0 self-distance (euclidean_distances of a block is only close to 0)
+        result[rows - start, rows] = 0
+        return result
+    if metric == 'kendall':
+        rows_values, norms, chunks = values
+        dots = np.zeros((stop - start, len(rows_values)))
+        for anchors in chunks:
+            # sign vectors of one chunk of feature pairs, for all rows
+            signs = _pair_signs(rows_values, anchors)
+            dots += signs[start:stop] @ signs.T
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result = dots / np.outer(norms[start:stop], norms)
+        result = np.clip(result, -1, 1)
+        # pandas' kendall has 1 on the whole diagonal, constant rows included
+        result[rows - start, rows] = 1.
+        return result
+    raise ValueError('Please choose metric from {}!'.format(SIMILARITY_METRICS + DISTANCE_METRICS))
+
+
+# rows of a process worker, set once by _init_block_worker
+_worker_values = None
+
+
+def _init_block_worker(values):
+    global _worker_values
+    _worker_values = values
+
+
+def _block_job(values, start, stop, metric, out_path):
+    # compute one row block, write it to the memory-mapped output if there is one,
+    # and return (start, block or None, (min, max))
+    values = values if values is not None else _worker_values
+    block = _pairwise_block(values, start, stop, metric)
+    extrema = (np.nanmin(block), np.nanmax(block)) if np.any(~np.isnan(block)) else (np.inf, -np.inf)
+    if out_path is None:
+        return start, block, extrema
+    out = np.lib.format.open_memmap(out_path, mode='r+')
+    out[start:stop] = block
+    out.flush()
+    return start, None, extrema
+
+
+def _store_block(job_result, result, extrema):
+    # copy a returned block into the result and update the running (min, max)
+    start, block, (block_min, block_max) = job_result
+    if block is not None:
+        result[start:start + len(block)] = block
+    return min(extrema[0], block_min), max(extrema[1], block_max)
+
+
+def pairwise_similarity(df, metric='cosine', scaled=True, n_jobs=1, backend='thread', memory_budget=256 * 2**20,
+                        out=None, dtype=np.float64):
+    ''' Similarity between each pair of rows of a DataFrame, computed in row blocks.
+
+    Rows are processed in blocks sized to memory_budget, in parallel over n_jobs
+    threads or processes. The global minimum and maximum are tracked while the
+    blocks are written (first pass); scaling into [0, 1] is a second pass over
+    the result, so nothing is recomputed.
+
+    Args:
+        df: DataFrame (or array) with one item per row
+        metric: 'cosine', 'pearson', 'spearman', 'kendall' (similarities) or
+            'manhattan', 'euclidean', 'canberra' (distances, turned into
+            similarities by max-minus). Correlations of rows with missing values
+            fall back to pandas' pairwise-complete DataFrame.corr
+        scaled: scale into [0, 1] as the *_similarity / *_scaled functions do
+        n_jobs: number of parallel workers
+        backend: 'thread' (numpy/scipy kernels release the GIL) or 'process'
+        memory_budget: approximate bytes of the temporary blocks per worker
+            (for kendall also of the feature-pair sign vectors of a block)
+        out: optional path of a .npy file; blocks are streamed into it as a
+            memory map instead of keeping the dense matrix in memory
+        dtype: dtype of the result
+
+    Return:
+        DataFrame indexed like df, or the np.memmap when out is given (rows and
+        columns in the order of df)
+    '''
+    index = df.index.values if isinstance(df, pd.DataFrame) else np.arange(len(df))
+    raw = np.asarray(df.values if isinstance(df, pd.DataFrame) else df, dtype=float)
+    n = len(raw)
+    if metric in ('pearson', 'spearman', 'kendall') and np.isnan(raw).any():
+        # pairwise-complete correlations with missing values: pandas, then the usual blocks/scaling
+        values, metric_kernel = pd.DataFrame(raw.T).corr(method=metric).values, 'precomputed'
+    else:
+        values, metric_kernel = _prepare_rows(raw, metric, memory_budget), metric
+    block_size = int(max(1, min(n, memory_budget // (2 * 8 * max(n, 1)))))
+    blocks = [(start, min(start + block_size, n)) for start in range(0, n, block_size)]
+
+    if out is None:
+        result = np.empty((n, n), dtype=dtype)
+    else:
+        result = np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=(n, n))
+        result.flush()
+
+    # pass 1: blocks and running extrema; at most 2 * n_jobs blocks are in flight
+    if backend == 'thread':
+        pool = ThreadPoolExecutor(max_workers=n_jobs)
+        shared, worker_out = values, None
+    else:
+        pool = ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_block_worker, initargs=(values,))
+        # process workers write their blocks to the memory map themselves
+        shared, worker_out = None, out
+    extrema = (np.inf, -np.inf)
+    with pool:
+        pending = deque()
+        for start, stop in blocks:
+            pending.append(pool.submit(_block_job, shared, start, stop, metric_kernel, worker_out))
+            if len(pending) >= 2 * n_jobs:
+                extrema = _store_block(pending.popleft().result(), result, extrema)
+        while len(pending) > 0:
+            extrema = _store_block(pending.popleft().result(), result, extrema)
+    value_min, value_max = extrema
+    if out is not None:
+        result.flush()
+        if backend != 'thread':
+            # the workers wrote through their own maps
+            result = np.lib.format.open_memmap(out, mode='r+')
+
+    # pass 2: global scaling in place, block by block
+    if scaled:
+        scale = value_max - value_min
+        for start, stop in blocks:
+            if metric in DISTANCE_METRICS:
+                result[start:stop] = (value_max - result[start:stop]) / scale
+            else:
+                result[start:stop] = (result[start:stop] - value_min) / scale
+    elif metric in DISTANCE_METRICS:
+        for start, stop in blocks:
+            result[start:stop] = value_max - result[start:stop]
+
+    if out is not None:
+        result.flush()
+        return result
+    return pd.DataFrame(result, index=index, columns=index)
@@ -0,0 +1,77 @@
+### CPU performance helpers: thread pools and local data-parallel training with gloo
+import os
+import socket
+import datetime
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+def configure_threads(num_threads=None, num_interop_threads=None):
+    ''' Set the torch intra-op and inter-op thread pools (None keeps the defaults).
+        Inter-op threads can only be set before the first parallel op of the
+        process; later calls leave the pool as it is.
+    '''
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None and torch.get_num_interop_threads() != num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            pass
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def broadcast_object(obj, src=0):
+    ''' Send a picklable object from rank src to every rank (no-op in a single process).
+    '''
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+def share_memory(data):
+    ''' Put an in-memory array into shared memory so spawned workers don't copy it.
+        Paths and memory-mapped arrays are returned unchanged.
+    '''
+    if isinstance(data, torch.Tensor):
+        return data.share_memory_()
+    if isinstance(data, np.ndarray) and not isinstance(data, np.memmap):
+        return torch.from_numpy(np.ascontiguousarray(data, dtype=np.float32)).share_memory_()
+    return data
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def _worker(rank, world_size, port, num_threads, fn, kwargs):
+    configure_threads(num_threads)
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:{}'.format(port), rank=rank,
+                            world_size=world_size, timeout=datetime.timedelta(hours=12))
+    try:
+        fn(**kwargs)
+    finally:
+        dist.destroy_process_group()
+
+def run_distributed(fn, n_processes, kwargs, num_threads=None):
+    ''' Run fn(**kwargs) in n_processes local processes joined in a gloo process group.
+
+    Args:
+        fn: picklable function, called in every process
+        n_processes: number of processes
+        kwargs: dict of keyword arguments for fn
+        num_threads: intra-op threads per process (default: cores / n_processes)
+    '''
+    if num_threads is None:
+        num_threads = max(1, (os.cpu_count() or 1) // n_processes)
+    mp.spawn(_worker, args=(n_processes, _free_port(), num_threads, fn, kwargs), nprocs=n_processes, join=True)
@@ -1,8 +1,14 @@
+import os
+import queue
+import threading
 import pandas as pd
 import numpy as np
 import pickle
 import dill
 
+# arrays written at the end of a MuSE run (and at each saved update epoch)
+OUTPUT_NAMES = ['latent', 'reconstruct_x', 'reconstruct_y', 'latent_x', 'latent_y']
+
 def save_obj(obj, fname, method='pickle', large_file=False):
     ''' Saving objects to designated filename in pickle format
     
@@ -37,4 +43,163 @@ def load_obj(fname, method='pickle'):
             return dill.load(f)
         else:
             raise ValueError('Please select method from {pickle, dill}!')
-        return
\ No newline at end of file
+        return
+
+def output_path(resultsdir, output_format='csv', suffix=''):
+    ''' Location of the outputs of a run written by `save_outputs`.
+
+    csv writes one file per array ('{resultsdir}_latent{suffix}.txt', ...), so the
+    path of the latent file is returned; npy and zarr write a single store.
+    '''
+    if output_format == 'csv':
+        return '{}_latent{}.txt'.format(resultsdir, suffix)
+    elif output_format == 'npy':
+        return '{}_outputs{}'.format(resultsdir, suffix)
+    elif output_format == 'zarr':
+        return '{}_outputs{}.zarr'.format(resultsdir, suffix)
+    else:
+        raise ValueError('Please select output_format from {csv, npy, zarr}!')
+
+def save_outputs(resultsdir, outputs, index_names, output_format='csv', suffix=''):
+    ''' Save the latents and reconstructions of a run.
+
+    Args:
+        resultsdir: prefix of the output files
+        outputs: dict {name: 2D numpy array}, usually the OUTPUT_NAMES arrays
+        index_names: row names
+        output_format: {csv, npy, zarr}
+            csv: one text file per array, '{resultsdir}_{name}{suffix}.txt'
+            npy: directory '{resultsdir}_outputs{suffix}' with one .npy per array
+                 plus index_names.npy, memory-mappable with `load_outputs`
+            zarr: zarr group '{resultsdir}_outputs{suffix}.zarr' (needs zarr)
+        suffix: appended to the names, e.g. '_{epoch}' for update epochs
+    '''
+    path = output_path(resultsdir, output_format, suffix)
+    if output_format == 'csv':
+        for name, values in outputs.items():
+            pd.DataFrame(values, index = index_names).to_csv('{}_{}{}.txt'.format(resultsdir, name, suffix))
+        return path
+
+    index_names = np.asarray(index_names)
+    if index_names.dtype == object:
+        index_names = index_names.astype(str)
+    if output_format == 'npy':
+        os.makedirs(path, exist_ok=True)
+        for name, values in outputs.items():
+            np.save(os.path.join(path, '{}.npy'.format(name)), np.ascontiguousarray(values))
+        np.save(os.path.join(path, 'index_names.npy'), index_names)
+    else:
+        import zarr
+        zarr.save_group(path, index_names=index_names, **{name: np.ascontiguousarray(values) for name, values in outputs.items()})
+    return path
+
+def create_output_store(path, shapes, index_names=None):
+    ''' Create an npy output store (as written by `save_outputs`) of memory-mapped
+        float32 arrays, to be filled incrementally (e.g. by `embed`).
+
+    Args:
+        path: store directory
+        shapes: dict {name: (N, dim)}
+        index_names: optional row names, saved as index_names.npy
+
+    Return:
+        dict {name: writable np.memmap}
+    '''
+    os.makedirs(path, exist_ok=True)
+    if index_names is not None:
+        index_names = np.asarray(index_names)
+        if index_names.dtype == object:
+            index_names = index_names.astype(str)
+        np.save(os.path.join(path, 'index_names.npy'), index_names)
+    return {name: np.lib.format.open_memmap(os.path.join(path, '{}.npy'.format(name)), mode='w+',
+                                             dtype=np.float32, shape=tuple(shape))
+            for name, shape in shapes.items()}
+
+def load_outputs(path, names=None, rows=None, mmap=True):
+    ''' Load outputs written by `save_outputs` with output_format npy or zarr.
+
+    Args:
+        path: store returned by `save_outputs` (or `output_path`)
+        names: arrays to load (default: all, including index_names)
+        rows: optional slice or index array; only these rows are read
+        mmap: memory-map the npy files instead of reading them
+
+    Return:
+        dict {name: numpy array}
+    '''
+    if str(path).endswith('.zarr'):
+        import zarr
+        group = zarr.open_group(path, mode='r')
+        available = sorted(name for name, _ in group.arrays())
+        read = lambda name: group[name]
+    elif os.path.isdir(path):
+        available = sorted(f[:-len('.npy')] for f in os.listdir(path) if f.endswith('.npy'))
+        read = lambda name: np.load(os.path.join(path, '{}.npy'.format(name)), mmap_mode='r' if mmap else None)
+    else:
+        raise ValueError('{} is not an npy or zarr output store!'.format(path))
+
+    outputs = {}
+    for name in (available if names is None else names):
+        values = read(name)
+        if rows is not None:
+            values = values[rows] if isinstance(rows, slice) else values[np.asarray(rows)]
+        elif not isinstance(values, np.ndarray):
+            values = values[...]
+        outputs[name] = values
+    return outputs
+
+def snapshot_state_dict(model):
+    ''' Copy of the model state on the CPU, safe to serialize while training goes on.
+    '''
+    return {name: value.detach().cpu().clone() for name, value in model.state_dict().items()}
+
+class CheckpointWriter:
+    ''' Serializes checkpoints on a background thread.
+
+    submit() queues a write and returns immediately; once max_pending writes are
+    queued it blocks, so snapshots waiting for the disk can't grow without limit.
+    Arguments must already be snapshots (see `snapshot_state_dict`). Errors raised
+    by a write are re-raised by the next submit()/flush().
+
+    Args:
+        max_pending: maximum number of queued writes
+    '''
+    def __init__(self, max_pending=2):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                fn, args, kwargs = job
+                if self.error is None:
+                    fn(*args, **kwargs)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, fn, *args, **kwargs):
+        self._check()
+        self.queue.put((fn, args, kwargs))
+
+    def flush(self):
+        ''' Wait until every queued write is on disk.
+        '''
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
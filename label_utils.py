@@ -0,0 +1,116 @@
+import numpy as np
+import torch
+import scipy.sparse as sp
+
+
+class PairwiseLabels:
+    ''' Sparse co-membership structure for user-supplied pairwise labels.
+
+    Only the positive pairs are kept, as sorted linear indices (row * n + col)
+    on the training device, so memory grows with the number of positive pairs
+    instead of N x N. Batch masks are built on the fly with a binary search.
+    '''
+    def __init__(self, matrix, device):
+        coo = sp.coo_matrix(matrix)
+        positive = coo.data > 0
+        self.n = coo.shape[0]
+        keys = coo.row[positive].astype(np.int64) * self.n + coo.col[positive].astype(np.int64)
+        self.keys = torch.from_numpy(np.unique(keys)).to(device)
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def shape(self):
+        return (self.n, self.n)
+
+    def to(self, device):
+        labels = PairwiseLabels.__new__(PairwiseLabels)
+        labels.n = self.n
+        labels.keys = self.keys.to(device)
+        return labels
+
+    def subset(self, rows):
+        ''' Return the labels restricted to `rows` (and re-indexed to 0..len(rows)-1).
+        '''
+        rows = np.asarray(rows, dtype=np.int64)
+        new_index = np.full(self.n, -1, dtype=np.int64)
+        new_index[rows] = np.arange(len(rows))
+        keys = self.keys.cpu().numpy()
+        row, col = new_index[keys // self.n], new_index[keys % self.n]
+        keep = (row >= 0) & (col >= 0)
+        matrix = sp.coo_matrix((np.ones(keep.sum(), dtype=np.float32), (row[keep], col[keep])),
+                               shape=(len(rows), len(rows)))
+        return PairwiseLabels(matrix, self.keys.device)
+
+    def batch(self, items):
+        ''' Return the bool (batch_size, batch_size) co-membership mask of `items`.
+        '''
+        items = torch.as_tensor(items, device=self.keys.device)
+        query = (items[:, None] * self.n + items[None, :]).flatten()
+        if len(self.keys) == 0:
+            return torch.zeros(len(items), len(items), dtype=torch.bool, device=self.keys.device)
+        position = torch.searchsorted(self.keys, query).clamp(max=len(self.keys) - 1)
+        return torch.eq(self.keys[position], query).view(len(items), len(items))
+
+
+def has_labels(labels):
+    ''' True if `labels` holds any labels (inputs default to an empty list).
+    '''
+    if labels is None:
+        return False
+    if hasattr(labels, 'shape'):
+        return labels.shape[0] > 0
+    return len(labels) > 0
+
+
+def make_labels(labels, device):
+    ''' Convert label input to the representation used during training.
+
+    Args:
+        labels: cluster ids of shape (N,) or (N, 1), or a pairwise (N, N)
+            co-membership matrix (dense or scipy.sparse, > 0 means same cluster)
+        device: training device
+
+    Return:
+        int64 tensor of cluster ids, or PairwiseLabels for pairwise input
+    '''
+    if isinstance(labels, PairwiseLabels):
+        return labels
+    if sp.issparse(labels):
+        return PairwiseLabels(labels, device)
+    if isinstance(labels, torch.Tensor):
+        labels = labels.detach().cpu().numpy()
+    labels = np.asarray(labels)
+    if (len(labels.shape) == 1) or (labels.shape[1] == 1):
+        # relabel to 0..n_clusters-1 so any hashable cluster id works
+        _, cluster_ids = np.unique(labels.reshape(-1), return_inverse=True)
+        return torch.from_numpy(cluster_ids.astype(np.int64)).to(device)
+    return PairwiseLabels(labels, device)
+
+
+def subset_labels(labels, rows):
+    ''' Restrict labels made by `make_labels` to the given rows.
+    '''
+    if isinstance(labels, PairwiseLabels):
+        return labels.subset(rows)
+    return labels[torch.as_tensor(rows, dtype=torch.long, device=labels.device)]
+
+
+def labels_to(labels, device):
+    ''' Move labels made by `make_labels` (or empty label input) to device.
+    '''
+    if isinstance(labels, (PairwiseLabels, torch.Tensor)):
+        return labels.to(device)
+    return labels
+
+
+def batch_labels(labels, items):
+    ''' Return the labels of a batch, ready for the triplet loss functions.
+    '''
+    if isinstance(labels, PairwiseLabels):
+        return labels.batch(items)
+    items = torch.as_tensor(items, device=labels.device)
+    if labels.dim() == 2:
+        return labels[items][:, items]
+    return labels[items]
@@ -0,0 +1,248 @@
+### Nearest-neighbour index over MuSE latents for top-k cosine queries
+import os
+import json
+import numpy as np
+import pandas as pd
+
+from .file_utils import output_path, load_outputs
+
+LATENT_INDEX_BACKENDS = ['auto', 'exact', 'hnsw']
+
+
+def latent_index_path(resultsdir):
+    ''' Location of the latent index of a run, next to '{resultsdir}.pth'.
+    '''
+    return '{}_latent_index'.format(resultsdir)
+
+
+def _unit_rows(latent):
+    latent = np.atleast_2d(np.asarray(latent, dtype=np.float32))
+    norm = np.linalg.norm(latent, axis=1, keepdims=True)
+    return latent / np.maximum(norm, 1e-8)
+
+
+class LatentIndex:
+    ''' Top-k cosine similarity search over latent embeddings.
+
+    Backends:
+        exact: blocked matrix products against the unit-normalized latents; exact
+            results, a single query is one (N, d) matrix-vector product
+        hnsw: hnswlib graph index (approximate, needs hnswlib)
+        auto: hnsw if hnswlib is installed, else exact
+
+    Items are numbered in the order they were added; `index_names` holds their
+    names. add() appends new items (e.g. newly embedded proteins) without a rebuild.
+
+    Args:
+        dim: latent dimension
+        backend: {auto, exact, hnsw}
+        M, ef_construction: hnsw graph degree and build-time search width
+        ef: hnsw query-time search width (at least k is used)
+        block_size: query rows per matrix product of the exact backend
+    '''
+    def __init__(self, dim, backend='auto', M=16, ef_construction=200, ef=64, block_size=1024):
+        if backend not in LATENT_INDEX_BACKENDS:
+            raise ValueError('Please choose backend from {}!'.format(LATENT_INDEX_BACKENDS))
+        if backend == 'auto':
+            try:
+                import hnswlib
+                backend = 'hnsw'
+            except ImportError:
+                backend = 'exact'
+        self.dim = dim
+        self.backend = backend
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef = ef
+        self.block_size = block_size
+        self.index_names = np.empty(0, dtype=object)
+        self._vectors = np.empty((0, dim), dtype=np.float32)
+        self._hnsw = None
+        if backend == 'hnsw':
+            import hnswlib
+            self._hnsw = hnswlib.Index(space='cosine', dim=dim)
+            self._hnsw.init_index(max_elements=1024, M=M, ef_construction=ef_construction)
+
+    def __len__(self):
+        return len(self.index_names)
+
+    @classmethod
+    def build(cls, latent, index_names=None, **kwargs):
+        ''' Index of the rows of latent (N, dim); index_names default to 0..N-1.
+        '''
+        latent = np.asarray(latent)
+        index = cls(latent.shape[1], **kwargs)
+        index.add(latent, index_names)
+        return index
+
+    def add(self, latent, index_names=None):
+        ''' Append the rows of latent (N, dim) or a single latent (dim,).
+        '''
+        latent = _unit_rows(latent)
+        if latent.shape[1] != self.dim:
+            raise ValueError('Latents of dimension {} cannot be added to an index of dimension {}!'.format(
+                latent.shape[1], self.dim))
+        if index_names is None:
+            index_names = np.arange(len(self), len(self) + len(latent))
+        index_names = np.atleast_1d(np.asarray(index_names, dtype=object))
+        if len(index_names) != len(latent):
+            raise ValueError('Got {} index_names for {} latents!'.format(len(index_names), len(latent)))
+        ids = np.arange(len(self), len(self) + len(latent))
+        if self.backend == 'hnsw':
+            if ids[-1] >= self._hnsw.get_max_elements():
+                self._hnsw.resize_index(max(2 * self._hnsw.get_max_elements(), ids[-1] + 1))
+            self._hnsw.add_items(latent, ids)
+        else:
+            # amortized growth: the buffer doubles when full
+            n = len(self)
+            if n + len(latent) > len(self._vectors):
+                vectors = np.empty((max(2 * len(self._vectors), n + len(latent)), self.dim), dtype=np.float32)
+                vectors[:n] = self._vectors[:n]
+                self._vectors = vectors
+            self._vectors[n:n + len(latent)] = latent
+        self.index_names = np.concatenate([self.index_names, index_names])
+        return ids
+
+    def query(self, latent, k=10, exclude=None):
+        ''' Top-k most cosine-similar indexed items of each query.
+
+        Args:
+            latent: query latents (Q, dim), or a single latent (dim,)
+            k: number of neighbours
+            exclude: optional item ids (Q,) to leave out of the results of each
+                query, e.g. the query item itself
+
+        Return:
+            ids (Q, k) int array and similarities (Q, k) float32 array, most similar
+            first (1D for a single query); ids are -1 where fewer than k items exist
+        '''
+        single = np.ndim(latent) == 1
+        latent = _unit_rows(latent)
+        k_search = min(k + (exclude is not None), len(self))
+        if k_search == 0:
+            ids, sims = np.empty((len(latent), 0), dtype=np.int64), np.empty((len(latent), 0), dtype=np.float32)
+        elif self.backend == 'hnsw':
+            self._hnsw.set_ef(max(self.ef, k_search))
+            ids, distances = self._hnsw.knn_query(latent, k=k_search)
+            ids, sims = ids.astype(np.int64), (1 - distances).astype(np.float32)
+        else:
+            ids, sims = self._exact_query(latent, k_search)
+        if exclude is not None:
+            keep = ids != np.asarray(exclude).reshape(-1, 1)
+            # drop the excluded item, or the last neighbour if it was not found
+            keep[keep.all(axis=1), -1] = False
+            ids, sims = ids[keep].reshape(len(ids), -1), sims[keep].reshape(len(ids), -1)
+        if ids.shape[1] < k:
+            pad = k - ids.shape[1]
+            ids = np.pad(ids, ((0, 0), (0, pad)), constant_values=-1)
+            sims = np.pad(sims, ((0, 0), (0, pad)), constant_values=np.nan)
+        return (ids[0], sims[0]) if single else (ids, sims)
+
+    def _exact_query(self, latent, k):
+        vectors = self._vectors[:len(self)]
+        ids = np.empty((len(latent), k), dtype=np.int64)
+        sims = np.empty((len(latent), k), dtype=np.float32)
+        for start in range(0, len(latent), self.block_size):
+            block = latent[start:start + self.block_size] @ vectors.T
+            top = np.argpartition(-block, k - 1, axis=1)[:, :k] if k < block.shape[1] else \
+                np.broadcast_to(np.arange(k), block.shape).copy()
+            top_sims = np.take_along_axis(block, top, axis=1)
+            order = np.argsort(-top_sims, axis=1, kind='stable')
+            ids[start:start + self.block_size] = np.take_along_axis(top, order, axis=1)
+            sims[start:start + self.block_size] = np.take_along_axis(top_sims, order, axis=1)
+        return ids, sims
+
+    def neighbors(self, names, k=10):
+        ''' Top-k neighbours of indexed items, by name, the items themselves excluded.
+
+        Args:
+            names: a name or a list of names from index_names
+            k: number of neighbours
+
+        Return:
+            DataFrame with columns query, rank, neighbor and similarity
+        '''
+        single = np.ndim(names) == 0
+        names = [names] if single else list(names)
+        position = pd.Index(self.index_names)
+        ids = position.get_indexer(names)
+        if (ids < 0).any():
+            raise KeyError('Not in the index: {}'.format([name for name, i in zip(names, ids) if i < 0]))
+        neighbor_ids, sims = self.query(self.vectors(ids), k, exclude=ids)
+        found = neighbor_ids >= 0
+        return pd.DataFrame(dict(query=np.repeat(np.asarray(names, dtype=object), k)[found.reshape(-1)],
+                                 rank=np.tile(np.arange(1, k + 1), len(names))[found.reshape(-1)],
+                                 neighbor=self.index_names[neighbor_ids[found]],
+                                 similarity=sims[found]))
+
+    def vectors(self, ids):
+        ''' Unit-normalized latents of the items ids.
+        '''
+        if self.backend == 'hnsw':
+            return np.asarray(self._hnsw.get_items(np.asarray(ids)), dtype=np.float32)
+        return self._vectors[np.asarray(ids)]
+
+    def save(self, path):
+        ''' Write the index to the directory path (see `latent_index_path`).
+        '''
+        os.makedirs(path, exist_ok=True)
+        meta = dict(dim=self.dim, backend=self.backend, M=self.M, ef_construction=self.ef_construction, ef=self.ef,
+                    block_size=self.block_size, n_items=len(self))
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+        np.save(os.path.join(path, 'index_names.npy'), self.index_names, allow_pickle=True)
+        if self.backend == 'hnsw':
+            self._hnsw.save_index(os.path.join(path, 'hnsw.bin'))
+        else:
+            np.save(os.path.join(path, 'latent.npy'), self._vectors[:len(self)])
+        return path
+
+    @classmethod
+    def load(cls, path, mmap=False):
+        ''' Read an index written by save(); mmap memory-maps the latents of the
+            exact backend (read-only until the first add()).
+        '''
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        n_items = meta.pop('n_items')
+        index = cls(**meta)
+        index.index_names = np.load(os.path.join(path, 'index_names.npy'), allow_pickle=True)
+        if index.backend == 'hnsw':
+            index._hnsw.load_index(os.path.join(path, 'hnsw.bin'), max_elements=max(n_items, 1))
+        else:
+            index._vectors = np.load(os.path.join(path, 'latent.npy'), mmap_mode='r' if mmap else None)
+        return index
+
+
+def build_latent_index(resultsdir, output_format='csv', latent=None, index_names=None, save=True, **kwargs):
+    ''' Build the latent index of a fitted run and save it next to '{resultsdir}.pth'.
+
+    Args:
+        resultsdir: prefix of the run outputs
+        output_format: {csv, npy, zarr}, format the latents were saved in
+        latent, index_names: the latents (N, dim) and their names; read from the
+            run outputs when latent is None
+        save: write the index to `latent_index_path(resultsdir)`
+        kwargs: LatentIndex options (backend, M, ef_construction, ef, block_size)
+
+    Return:
+        LatentIndex
+    '''
+    if latent is None:
+        path = output_path(resultsdir, output_format)
+        if output_format == 'csv':
+            latent = pd.read_csv(path, index_col=0)
+            index_names, latent = latent.index.values, latent.values
+        else:
+            outputs = load_outputs(path, names=['latent', 'index_names'])
+            index_names, latent = outputs['index_names'], outputs['latent']
+    index = LatentIndex.build(latent, index_names, **kwargs)
+    if save:
+        index.save(latent_index_path(resultsdir))
+    return index
+
+
+def load_latent_index(resultsdir, mmap=False):
+    ''' Load the latent index saved by `build_latent_index` for a run.
+    '''
+    return LatentIndex.load(latent_index_path(resultsdir), mmap)
@@ -0,0 +1,214 @@
+import os
+import json
+import torch
+import torch.distributed as dist
+import numpy as np
+
+# order of the fields in the per-epoch log line
+METRIC_NAMES = ['total_loss',
+                'reconstruction_loss_x', 'reconstruction_loss_y',
+                'sparse_penalty',
+                'x_triplet_loss_batch_hard', 'y_triplet_loss_batch_hard',
+                'x_triplet_loss_batch_all', 'y_triplet_loss_batch_all',
+                'x_fraction_hard', 'y_fraction_hard',
+                'x_fraction_semi', 'y_fraction_semi',
+                'x_fraction_easy', 'y_fraction_easy']
+
+
+class EpochMetrics:
+    ''' Mean of every training metric over the batches of one epoch.
+
+    Values are plain floats, available as attributes, by name or via as_dict().
+    '''
+    def __init__(self, phase, epoch, values, n_batches):
+        self.phase = phase
+        self.epoch = epoch
+        self.values = dict(zip(METRIC_NAMES, values))
+        self.n_batches = n_batches
+
+    def __getattr__(self, name):
+        values = self.__dict__.get('values', {})
+        if name in values:
+            return values[name]
+        raise AttributeError(name)
+
+    def __getitem__(self, name):
+        return self.values[name]
+
+    def as_dict(self):
+        return dict(phase=self.phase, epoch=self.epoch, n_batches=self.n_batches, **self.values)
+
+    def format_line(self):
+        ''' Tab-separated line as written to the training log.
+        '''
+        return self.phase + '_epoch:%d\t' % self.epoch + '\t'.join(
+            '%s:%03.5f' % (name, self.values[name]) for name in METRIC_NAMES)
+
+    def __repr__(self):
+        return 'EpochMetrics({})'.format(self.format_line())
+
+
+class MetricsAccumulator:
+    ''' Running sums of the per-batch metrics, kept on the training device.
+
+    add() only queues device ops, so no host synchronization happens until
+    result() copies the sums back once at the end of the epoch.
+    '''
+    def __init__(self, device):
+        self.sums = torch.zeros(len(METRIC_NAMES), device=device)
+        self.n_batches = 0
+
+    def add(self, *values):
+        ''' Add one batch, values given as scalar tensors in METRIC_NAMES order.
+        '''
+        self.sums += torch.stack([v.detach().float() for v in values])
+        self.n_batches += 1
+
+    def result(self, phase, epoch):
+        sums, n_batches = self.sums, self.n_batches
+        if dist.is_available() and dist.is_initialized():
+            # data-parallel training: average over the batches of every process
+            totals = torch.cat([sums, torch.tensor([float(n_batches)], device=sums.device)])
+            dist.all_reduce(totals)
+            sums, n_batches = totals[:-1], int(totals[-1].item())
+        if n_batches == 0:
+            means = np.full(len(METRIC_NAMES), np.nan)
+        else:
+            means = (sums / n_batches).cpu().numpy()
+        return EpochMetrics(phase, epoch, [float(v) for v in means], n_batches)
+
+
+class MetricsSink:
+    ''' Buffered writer of structured training records, one dict per epoch or event.
+
+    Records carry a 'record' field ('epoch', 'phase_end' or 'cluster_update');
+    epoch records hold the fields of EpochMetrics.as_dict(). Records are written
+    every buffer_size records and on flush() / close().
+
+    A run resumed from a checkpoint appends to the sink of the interrupted run
+    and repeats the epochs after that checkpoint, so epochs can appear twice;
+    `load_metrics(..., keep='last')` keeps the records of the resumed run.
+    '''
+    def __init__(self, fname, buffer_size=64, append=False):
+        self.fname = fname
+        self.buffer_size = buffer_size
+        self.append = append
+        self.buffer = []
+
+    def write(self, record):
+        self.buffer.append(record)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        raise NotImplementedError
+
+    def close(self):
+        self.flush()
+
+
+class JsonlMetricsSink(MetricsSink):
+    ''' Records as JSON lines.
+    '''
+    def __init__(self, fname, buffer_size=64, append=False):
+        super().__init__(fname, buffer_size, append)
+        self.file = open(fname, 'a' if append else 'w')
+
+    def flush(self):
+        for record in self.buffer:
+            self.file.write(json.dumps(record) + '\n')
+        self.buffer = []
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+# fixed Parquet columns; fields of other records go to the JSON 'info' column
+PARQUET_COLUMNS = ['record', 'phase', 'epoch', 'n_batches'] + METRIC_NAMES + ['info']
+
+
+class ParquetMetricsSink(MetricsSink):
+    ''' Records as a Parquet dataset with the PARQUET_COLUMNS schema (needs pyarrow).
+
+    fname is a directory; every flush writes one complete file 'part-NNNNN.parquet'
+    (through a temporary file and a rename), so everything flushed before an
+    interruption stays readable. Appending adds parts after the existing ones.
+    '''
+    def __init__(self, fname, buffer_size=64, append=False):
+        import pyarrow as pa
+        super().__init__(fname, buffer_size, append)
+        self.schema = pa.schema([('record', pa.string()), ('phase', pa.string()), ('epoch', pa.int64()),
+                                 ('n_batches', pa.int64())] + [(name, pa.float64()) for name in METRIC_NAMES] +
+                                [('info', pa.string())])
+        os.makedirs(fname, exist_ok=True)
+        parts = _parquet_parts(fname)
+        if not append:
+            for part in parts:
+                os.remove(part)
+            parts = []
+        self.n_parts = int(os.path.basename(parts[-1])[len('part-'):-len('.parquet')]) + 1 if len(parts) > 0 else 0
+
+    def flush(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if len(self.buffer) == 0:
+            return
+        columns = {name: [] for name in PARQUET_COLUMNS}
+        for record in self.buffer:
+            for name in PARQUET_COLUMNS[:-1]:
+                columns[name].append(record.get(name))
+            info = {key: value for key, value in record.items() if key not in columns}
+            columns['info'].append(json.dumps(info) if len(info) > 0 else None)
+        part = os.path.join(self.fname, 'part-%05d.parquet' % self.n_parts)
+        pq.write_table(pa.table(columns, schema=self.schema), part + '.tmp')
+        os.replace(part + '.tmp', part)
+        self.n_parts += 1
+        self.buffer = []
+
+
+def _parquet_parts(path):
+    # complete part files of a Parquet metrics dataset, in write order
+    return sorted(os.path.join(path, f) for f in os.listdir(path) if f.startswith('part-') and f.endswith('.parquet'))
+
+
+def metrics_path(resultsdir, metrics_format):
+    return '{}_metrics.{}'.format(resultsdir, metrics_format)
+
+
+def open_metrics_sink(resultsdir, metrics_format, append=False, buffer_size=64):
+    ''' Open the sink of a run, metrics_format 'jsonl' or 'parquet' (None: no sink).
+    '''
+    if metrics_format is None:
+        return None
+    if metrics_format == 'jsonl':
+        return JsonlMetricsSink(metrics_path(resultsdir, metrics_format), buffer_size, append)
+    if metrics_format == 'parquet':
+        return ParquetMetricsSink(metrics_path(resultsdir, metrics_format), buffer_size, append)
+    raise ValueError('Please choose metrics_format "jsonl" or "parquet"!')
+
+
+def load_metrics(fname, record='epoch', keep='all'):
+    ''' Read the records of a metrics file (.jsonl or .parquet) into a DataFrame.
+
+    Args:
+        fname: path of the metrics file (the directory of a Parquet sink)
+        record: keep only this record type (None: all records)
+        keep: 'all' records, or 'last' to drop the earlier copies of epoch
+            records repeated by a resumed run (same phase and epoch)
+    '''
+    import pandas as pd
+    if fname.endswith('.parquet'):
+        parts = _parquet_parts(fname)
+        metrics = pd.concat([pd.read_parquet(part) for part in parts], ignore_index=True) if len(parts) > 0 else \
+            pd.DataFrame(columns=PARQUET_COLUMNS)
+    else:
+        metrics = pd.read_json(fname, lines=True)
+    if keep == 'last' and len(metrics) > 0:
+        epochs = metrics['record'] == 'epoch'
+        repeated = epochs & metrics[epochs].duplicated(['phase', 'epoch'], keep='last').reindex(metrics.index, fill_value=False)
+        metrics = metrics[~repeated].reset_index(drop=True)
+    if record is not None:
+        metrics = metrics[metrics['record'] == record].dropna(axis=1, how='all').reset_index(drop=True)
+    return metrics
@@ -0,0 +1,171 @@
+### Opt-in mixed precision (autocast) and torch.compile execution of the training step
+import itertools
+import contextlib
+import torch
+
+from .triplet_loss import paired_triplet_losses
+
+# autocast dtype of each precision mode (None: plain float32)
+PRECISIONS = {'float32': None, 'bfloat16': torch.bfloat16, 'float16': torch.float16}
+
+
+def autocast_dtype(precision):
+    if precision not in PRECISIONS:
+        raise ValueError('Please choose precision from {}!'.format(list(PRECISIONS)))
+    return PRECISIONS[precision]
+
+
+def autocast(device, dtype):
+    ''' Autocast context for the model forward (no-op for dtype None).
+    '''
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(torch.device(device).type, dtype=dtype)
+
+
+def compile_training_step(model, compile_mode=None, triplet_chunk_size=None):
+    ''' Compile the model and the fused triplet losses with torch.compile.
+
+    Args:
+        model: the module used for training (possibly DistributedDataParallel)
+        compile_mode: torch.compile mode, e.g. 'default', 'reduce-overhead' or 'max-autotune'
+        triplet_chunk_size: anchor chunking of the triplet losses; chunked losses are
+            recomputed in backward with torch.utils.checkpoint, which dynamo cannot
+            trace, so they stay eager
+
+    Return:
+        compiled model, `paired_triplet_losses` (compiled unless chunked)
+    '''
+    # the last batch of an epoch is smaller, dynamic shapes avoid a recompile per size
+    compiled = torch.compile(model, mode=compile_mode, dynamic=True)
+    if triplet_chunk_size is not None:
+        return compiled, paired_triplet_losses
+    return compiled, torch.compile(paired_triplet_losses, mode=compile_mode, dynamic=True)
+
+
+def check_execution_mode(model, batch_x, batch_y, label_x, label_y, precision='bfloat16', compiled=None,
+                         triplet_losses=None, margin=0.1, device='cpu', latent_atol=5e-2, loss_rtol=5e-2,
+                         metric='cosine', normalized=False, chunk_size=None, loss_atol=1e-3):
+    ''' Compare a forward pass and the losses of one batch against the float32 eager path.
+
+    The model is evaluated in eval mode (no dropout, running batch norm statistics)
+    so both paths see the same function. The reference computes the full cosine
+    distance, so the normalized shortcut of the tested path is checked as well.
+
+    Args:
+        model: the eager structured_embedding
+        batch_x, batch_y: one batch of inputs
+        label_x, label_y: labels of the batch, as for `paired_triplet_losses`
+        precision: autocast precision of the tested path
+        compiled: compiled model of the tested path (None: the eager model)
+        triplet_losses: triplet function of the tested path (None: paired_triplet_losses)
+        margin: triplet margin
+        latent_atol: tolerance of the largest absolute latent difference
+        loss_rtol, loss_atol: the reconstruction and triplet losses pass if
+            |loss - reference| <= loss_atol + loss_rtol * |reference| (as torch.allclose)
+        metric, normalized: latent distance of the triplet losses (of the tested path)
+        chunk_size: anchor chunking of the tested triplet losses
+
+    Return:
+        dict of latent_max_abs_diff, loss_max_abs_diff, loss_max_rel_diff and ok
+    '''
+    compiled = compiled if compiled is not None else model
+    triplet_losses = triplet_losses if triplet_losses is not None else paired_triplet_losses
+    was_training = model.training
+    model.eval()
+
+    def losses(net, loss_fn, dtype, chunk_size, normalized):
+        with torch.no_grad():
+            with autocast(device, dtype):
+                latent, reconstruct_x, reconstruct_y, latent_x, latent_y = net(batch_x, batch_y)
+            loss_x, loss_y = loss_fn(label_x, label_y, latent, margin, device, chunk_size=chunk_size, metric=metric,
+                                     normalized=normalized)
+            latent = latent.float()
+            values = torch.stack([torch.norm(reconstruct_x.float() - batch_x), torch.norm(reconstruct_y.float() - batch_y),
+                                  loss_x[0], loss_y[0], loss_x[1], loss_y[1]])
+        return latent, values
+
+    try:
+        reference_latent, reference = losses(model, paired_triplet_losses, None, None, False)
+        latent, values = losses(compiled, triplet_losses, autocast_dtype(precision), chunk_size, normalized)
+    finally:
+        model.train(was_training)
+    latent_diff = float((latent - reference_latent).abs().max())
+    loss_abs_diff, loss_rel_diff = _loss_diffs(values, reference)
+    return dict(latent_max_abs_diff=latent_diff, loss_max_abs_diff=loss_abs_diff, loss_max_rel_diff=loss_rel_diff,
+                ok=latent_diff <= latent_atol and torch.allclose(values, reference, rtol=loss_rtol, atol=loss_atol))
+
+
+def _loss_diffs(values, reference):
+    # largest absolute and relative difference of the losses
+    diff = (values - reference).abs()
+    return float(diff.max()), float((diff / reference.abs().clamp(min=1e-12)).max())
+
+
+def verify_execution_modes(n_samples=256, dim_x=64, dim_y=32, latent_dim=32, n_clusters=8, chunk_size=16,
+                           precisions=('float32', 'bfloat16'), compile_modes=(False, True), device='cpu',
+                           atol=1e-3, rtol=5e-2, seed=0):
+    ''' Tolerance test of the execution modes of a training step against the eager float32 step.
+
+    For every combination of precision, compile, triplet chunking (None and
+    chunk_size) and the normalized distance shortcut (used with l2_norm, the
+    default), one training-mode forward and backward of the reconstruction and
+    triplet losses is run from the same weights and inputs. The losses and the
+    parameter gradients are compared with eager float32 without chunking and with
+    the full cosine distance. Dropout is disabled so both paths compute the same
+    function.
+
+    Losses pass if |loss - reference| <= atol + rtol * |reference|; gradients if
+    ||grad - reference|| <= rtol * ||reference||.
+
+    Return:
+        list of dicts (precision, compile, chunk_size, normalized, loss_max_abs_diff,
+        loss_max_rel_diff, grad_max_rel_diff, ok), one per combination
+    '''
+    from .architecture import structured_embedding
+
+    generator = torch.Generator().manual_seed(seed)
+    clusters = torch.randint(0, n_clusters, (n_samples,), generator=generator)
+    batch_x = (torch.randn(n_clusters, dim_x, generator=generator)[clusters]
+               + torch.randn(n_samples, dim_x, generator=generator)).to(device)
+    batch_y = (torch.randn(n_clusters, dim_y, generator=generator)[clusters]
+               + torch.randn(n_samples, dim_y, generator=generator)).to(device)
+    label_x = clusters.to(device)
+    label_y = torch.randint(0, n_clusters, (n_samples,), generator=generator).to(device)
+    torch.manual_seed(seed)
+    model = structured_embedding(dim_x, dim_y, latent_dim, 128, 0., True).to(device)
+    state = {name: value.clone() for name, value in model.state_dict().items()}
+
+    def step(precision, compiled, chunk, normalized):
+        model.load_state_dict(state)
+        model.zero_grad()
+        net, loss_fn = compile_training_step(model, None, chunk) if compiled else (model, paired_triplet_losses)
+        with autocast(device, autocast_dtype(precision)):
+            latent, reconstruct_x, reconstruct_y, latent_x, latent_y = net(batch_x, batch_y)
+        loss_x, loss_y = loss_fn(label_x, label_y, latent, 0.1, device, chunk_size=chunk, normalized=normalized)
+        values = torch.stack([torch.norm(reconstruct_x.float() - batch_x), torch.norm(reconstruct_y.float() - batch_y),
+                              loss_x[0], loss_y[0], loss_x[1], loss_y[1]])
+        values.sum().backward()
+        grads = torch.cat([parameter.grad.reshape(-1) for parameter in model.parameters()])
+        return values.detach(), grads
+
+    reference, reference_grads = step('float32', False, None, False)
+    results = []
+    for precision, compiled, chunk, normalized in itertools.product(precisions, compile_modes, (None, chunk_size),
+                                                                    (False, True)):
+        values, grads = step(precision, compiled, chunk, normalized)
+        loss_abs_diff, loss_rel_diff = _loss_diffs(values, reference)
+        grad_diff = float((grads - reference_grads).norm() / reference_grads.norm().clamp(min=1e-12))
+        results.append(dict(precision=precision, compile=compiled, chunk_size=chunk, normalized=normalized,
+                            loss_max_abs_diff=loss_abs_diff, loss_max_rel_diff=loss_rel_diff, grad_max_rel_diff=grad_diff,
+                            ok=torch.allclose(values, reference, rtol=rtol, atol=atol) and grad_diff <= rtol))
+    return results
+
+
+if __name__ == '__main__':
+    # python -m <package>.precision: exits non-zero if a mode is out of tolerance
+    import sys
+    results = verify_execution_modes()
+    for result in results:
+        print(result)
+    sys.exit(0 if all(result['ok'] for result in results) else 1)
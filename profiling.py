@@ -0,0 +1,176 @@
+### Wall time and memory of training phases, re-clustering, checkpoint writes and batch stages
+import sys
+import json
+import time
+import resource
+import threading
+import contextlib
+import torch
+
+
+def peak_rss_mb():
+    ''' Peak resident set size of this process so far, in MB.
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+
+def current_rss_mb():
+    ''' Current resident set size in MB (peak RSS where /proc is not available).
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024**2
+    except (OSError, IndexError, ValueError):
+        return peak_rss_mb()
+
+
+def _cuda_sync():
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        torch.cuda.synchronize()
+
+
+class Profiler:
+    ''' Collects timed events of a muse_fit_predict run.
+
+    Every event is a dict with 'kind' ('phase', 'recluster', 'recluster_wait',
+    'checkpoint', 'output' or 'batch_stages'), 'name', 'seconds', 'time' (seconds
+    since the profiler was created), 'rss_mb', 'peak_rss_mb' (and 'cuda_peak_mb' on
+    GPU) plus event specific fields. Batch stages (data_fetch, forward,
+    triplet_loss, backward, optimizer_step) are summed over the batches of an
+    epoch and reported as one 'batch_stages' event with a 'stages' dict.
+
+    Events are kept in `events` and passed to every callback. Checkpoint and
+    output events come from the background writer thread.
+
+    Args:
+        callbacks: optional list of functions called with each event
+        trace_dir: if set, record a torch.profiler trace (TensorBoard format) of
+            trace_active batches after trace_wait + trace_warmup batches
+        trace_wait, trace_warmup, trace_active: torch.profiler schedule, in batches
+        sync_cuda: synchronize CUDA at stage boundaries so GPU time is attributed
+            to the right stage
+    '''
+    def __init__(self, callbacks=None, trace_dir=None, trace_wait=1, trace_warmup=1, trace_active=5, sync_cuda=True):
+        self.callbacks = list(callbacks) if callbacks is not None else []
+        self.trace_dir = trace_dir
+        self.trace_schedule = dict(wait=trace_wait, warmup=trace_warmup, active=trace_active, repeat=1)
+        self.sync_cuda = sync_cuda
+        self.events = []
+        self.stage_seconds = {}
+        self._trace = None
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    def add_callback(self, fn):
+        self.callbacks.append(fn)
+
+    def emit(self, kind, name, seconds, **info):
+        event = dict(kind=kind, name=name, seconds=seconds, time=time.perf_counter() - self._start,
+                     rss_mb=current_rss_mb(), peak_rss_mb=peak_rss_mb(), **info)
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            event['cuda_peak_mb'] = torch.cuda.max_memory_allocated() / 1024**2
+        with self._lock:
+            self.events.append(event)
+        for callback in self.callbacks:
+            callback(event)
+        return event
+
+    def begin(self, kind, name, **info):
+        ''' Start a section; pass the returned token to end().
+        '''
+        return (kind, name, info, time.perf_counter())
+
+    def end(self, token, **info):
+        kind, name, begin_info, start = token
+        return self.emit(kind, name, time.perf_counter() - start, **begin_info, **info)
+
+    @contextlib.contextmanager
+    def section(self, kind, name, **info):
+        token = self.begin(kind, name, **info)
+        try:
+            yield
+        finally:
+            self.end(token)
+
+    def timed(self, kind, name, fn, **info):
+        ''' Return fn wrapped in a section, e.g. for work submitted to another thread.
+        '''
+        def run(*args, **kwargs):
+            with self.section(kind, name, **info):
+                return fn(*args, **kwargs)
+        return run
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        ''' Time one batch stage; summed until end_epoch().
+        '''
+        if self.sync_cuda:
+            _cuda_sync()
+        start = time.perf_counter()
+        with torch.profiler.record_function(name) if self._trace is not None else contextlib.nullcontext():
+            yield
+        if self.sync_cuda:
+            _cuda_sync()
+        self.stage_seconds[name] = self.stage_seconds.get(name, 0.) + time.perf_counter() - start
+
+    def iter_stage(self, iterable, name='data_fetch'):
+        ''' Iterate over batches, timing each fetch as a stage and stepping the trace.
+        '''
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.stage_seconds[name] = self.stage_seconds.get(name, 0.) + time.perf_counter() - start
+            yield batch
+            if self._trace is not None:
+                self._trace.step()
+
+    def end_epoch(self, phase, epoch, n_batches):
+        stages, self.stage_seconds = self.stage_seconds, {}
+        return self.emit('batch_stages', phase, sum(stages.values()), epoch=epoch, n_batches=n_batches, stages=stages)
+
+    def start_trace(self):
+        if self.trace_dir is None or self._trace is not None:
+            return
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._trace = torch.profiler.profile(activities=activities,
+                                             schedule=torch.profiler.schedule(**self.trace_schedule),
+                                             on_trace_ready=torch.profiler.tensorboard_trace_handler(self.trace_dir),
+                                             record_shapes=True, profile_memory=True)
+        self._trace.__enter__()
+
+    def stop_trace(self):
+        if self._trace is not None:
+            self._trace.__exit__(None, None, None)
+            self._trace = None
+
+    def summary(self):
+        ''' Total, mean and max seconds per (kind, name) as a DataFrame; batch stages
+            are broken down by stage.
+        '''
+        import pandas as pd
+        rows = []
+        for event in list(self.events):
+            if event['kind'] == 'batch_stages':
+                rows += [dict(kind='stage', name=stage, seconds=seconds) for stage, seconds in event['stages'].items()]
+            else:
+                rows.append(dict(kind=event['kind'], name=event['name'], seconds=event['seconds']))
+        if len(rows) == 0:
+            return pd.DataFrame(columns=['kind', 'name', 'count', 'total_seconds', 'mean_seconds', 'max_seconds'])
+        summary = pd.DataFrame(rows).groupby(['kind', 'name'])['seconds'].agg(['count', 'sum', 'mean', 'max'])
+        summary.columns = ['count', 'total_seconds', 'mean_seconds', 'max_seconds']
+        return summary.reset_index()
+
+    def save(self, fname):
+        ''' Write the events as JSON lines.
+        '''
+        with open(fname, 'w') as f:
+            for event in list(self.events):
+                f.write(json.dumps(event) + '\n')
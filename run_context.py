@@ -0,0 +1,105 @@
+### Per-run configuration passed to train_model instead of module globals
+import contextlib
+import torch
+
+from .triplet_loss import paired_triplet_losses
+
+
+class RunContext:
+    ''' Configuration, device and log handles of one muse_fit_predict run.
+
+    Each run owns its context, so several fits can run in one process (threads,
+    sweeps) without sharing state.
+
+    Args:
+        log_file: open file the per-epoch lines are written to
+        device: training device
+        lambda_regul: weight of the sparse penalty
+        triplet_margin: margin of the triplet losses
+        hard_loss: use the batch-hard instead of the batch-all triplet loss
+        triplet_chunk_size: anchor block size of the triplet losses (None: whole batch)
+        triplet_metric: latent distance of the triplet losses, 'cosine' or 'euclidean'
+        normalized_embeddings: the latents are unit-norm (l2_norm=True), which lets the
+            distance kernel skip the norms
+        history: optional list that receives the EpochMetrics of every epoch
+        profiler: optional Profiler that receives timing events
+        metrics_sink: optional MetricsSink that receives a structured record of every
+            epoch and event
+        autocast_dtype: dtype the model forward is autocast to (None: float32)
+        triplet_losses: function computing the x and y triplet losses
+            (paired_triplet_losses, or its compiled version)
+
+    Phase ends are kept in `transitions` as dicts of phase, epochs and trigger.
+    '''
+    def __init__(self, log_file=None, device=torch.device('cpu'), lambda_regul=5, triplet_margin=0.1,
+                 hard_loss=False, triplet_chunk_size=None, history=None, profiler=None,
+                 metrics_sink=None, autocast_dtype=None, triplet_losses=paired_triplet_losses, triplet_metric='cosine',
+                 normalized_embeddings=False):
+        self.log_file = log_file
+        self.device = device
+        self.lambda_regul = lambda_regul
+        self.triplet_margin = triplet_margin
+        self.hard_loss = hard_loss
+        self.triplet_chunk_size = triplet_chunk_size
+        self.history = history
+        self.profiler = profiler
+        self.metrics_sink = metrics_sink
+        self.autocast_dtype = autocast_dtype
+        self.triplet_losses = triplet_losses
+        self.triplet_metric = triplet_metric
+        self.normalized_embeddings = normalized_embeddings
+        self.transitions = []
+
+    def log_epoch(self, epoch_metrics):
+        print(epoch_metrics.format_line(), file = self.log_file)
+        self.record('epoch', **epoch_metrics.as_dict())
+        if self.history is not None:
+            self.history.append(epoch_metrics)
+
+    def log(self, line):
+        print(line, file = self.log_file)
+
+    def close(self):
+        ''' Flush and close the metrics sink and the log file.
+        '''
+        if self.metrics_sink is not None:
+            self.metrics_sink.close()
+        if self.log_file is not None:
+            self.log_file.close()
+
+    def flush(self):
+        ''' Write the buffered metrics records and log lines, e.g. before a checkpoint.
+        '''
+        if self.metrics_sink is not None:
+            self.metrics_sink.flush()
+        if self.log_file is not None:
+            self.log_file.flush()
+
+    def record(self, record, **fields):
+        if self.metrics_sink is not None:
+            self.metrics_sink.write(dict(record=record, **fields))
+
+    def log_transition(self, phase, n_epochs, trigger):
+        self.transitions.append(dict(phase=phase, epochs=n_epochs, trigger=trigger))
+        self.record('phase_end', phase=phase, epochs=n_epochs, trigger=trigger)
+        print('phase_end\tphase:%s\tepochs:%d\ttrigger:%s' % (phase, n_epochs, trigger), file = self.log_file)
+
+    # profiling hooks, no-ops without a profiler
+    def section(self, kind, name, **info):
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.section(kind, name, **info)
+
+    def begin(self, kind, name, **info):
+        return self.profiler.begin(kind, name, **info) if self.profiler is not None else None
+
+    def end(self, token, **info):
+        if token is not None:
+            self.profiler.end(token, **info)
+
+    def timed(self, kind, name, fn, **info):
+        return self.profiler.timed(kind, name, fn, **info) if self.profiler is not None else fn
+
+    def emit(self, kind, name, seconds, **info):
+        if self.profiler is not None:
+            self.profiler.emit(kind, name, seconds, **info)
@@ -0,0 +1,126 @@
+### Hyperparameter sweeps over muse_fit_predict that share the input preprocessing
+import copy
+import time
+import random
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import torch
+
+from .distributed import configure_threads
+from .label_utils import has_labels
+from .metrics import METRIC_NAMES
+
+# prepared inputs of a worker process, keyed by k (set once by _init_worker)
+_worker_inputs = {}
+
+
+def expand_grid(grid):
+    ''' Expand {name: [values]} into the list of all combinations as config dicts.
+    '''
+    names = list(grid.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+def _init_worker(prepared, num_threads, start_method):
+    configure_threads(num_threads)
+    # workers are spawned, but pools created inside a fit (e.g. by phenograph) should
+    # start like in the parent; spawning them re-imports torch for every clustering
+    multiprocessing.set_start_method(start_method, force=True)
+    _worker_inputs.clear()
+    _worker_inputs.update(prepared)
+
+
+def _run_config(run, resultsdir, config, common, prepared=None):
+    # one fit of the sweep; returns its summary row
+    from . import muse_fit_predict
+    if prepared is None:
+        prepared = _worker_inputs[config.get('k', common.get('k', 10))]
+    history = []
+    kwargs = dict(common)
+    kwargs.update(config)
+    start = time.time()
+    muse_fit_predict(resultsdir, None, None, prepared=prepared, history=history, **kwargs)
+    row = dict(run=run, resultsdir=resultsdir, **config)
+    row['seconds'] = time.time() - start
+    if len(history) > 0:
+        row['final_phase'] = history[-1].phase
+        row['final_epoch'] = history[-1].epoch
+        row.update({name: history[-1][name] for name in METRIC_NAMES})
+        # epochs actually run per phase (phases can end early on convergence)
+        for epoch_metrics in history:
+            row['epochs_' + epoch_metrics.phase] = row.get('epochs_' + epoch_metrics.phase, 0) + 1
+    return row
+
+
+def muse_sweep(resultsdir, data_x, data_y, configs, index_names=[], label_x=[], label_y=[], test_subset=[],
+               n_workers=1, threads_per_worker=None, **common):
+    ''' Fit MUSE once per hyperparameter config, preprocessing the inputs only once.
+
+    Tensor conversion, the train split and the initial clustering of the inputs are
+    identical across configs, so they run once per distinct k and are shared with
+    every fit (through shared memory when n_workers > 1).
+
+    Args:
+        resultsdir: prefix of the outputs; run i writes '{resultsdir}_{i}*' and the
+            summary goes to '{resultsdir}_summary.csv'
+        data_x, data_y, index_names, label_x, label_y, test_subset: as in muse_fit_predict
+        configs: list of dicts of muse_fit_predict arguments (e.g. latent_dim, lambda_super,
+            lambda_regul, triplet_margin, k, dropout), or a dict of value lists that is
+            expanded to all combinations
+        n_workers: number of fits run in parallel processes
+        threads_per_worker: torch threads of each fit (default: cores / n_workers)
+        common: further muse_fit_predict arguments shared by all configs
+
+    Return:
+        pandas DataFrame with one row per config: the config, the run's resultsdir,
+        the wall time, the number of epochs of every phase and the metrics of its
+        final epoch
+    '''
+    from . import prepare_inputs
+
+    if isinstance(configs, dict):
+        configs = expand_grid(configs)
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (multiprocessing.cpu_count() or 1) // n_workers)
+
+    # parallel workers get CPU tensors in shared memory
+    device = common.get('device')
+    if n_workers > 1 or device is None:
+        device = 'cuda' if torch.cuda.is_available() and n_workers == 1 else 'cpu'
+
+    seed = common.get('seed')
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+
+    # the initial clustering depends on k only when labels have to be created
+    default_k = common.get('k', 10)
+    needs_clustering = not has_labels(label_x) or not has_labels(label_y)
+    prepared = {}
+    for k in dict.fromkeys(config.get('k', default_k) for config in configs):
+        if not needs_clustering and len(prepared) > 0:
+            prepared[k] = next(iter(prepared.values()))
+            continue
+        prepared[k] = prepare_inputs(data_x, data_y, index_names, label_x, label_y, test_subset, k,
+                                     copy.deepcopy(common.get('cluster_backend')), device, seed=seed)
+
+    runs = [(run, '{}_{}'.format(resultsdir, run), config) for run, config in enumerate(configs)]
+    if n_workers == 1:
+        configure_threads(threads_per_worker)
+        rows = [_run_config(run, run_dir, config, common, prepared[config.get('k', default_k)])
+                for run, run_dir, config in runs]
+    else:
+        for inputs in prepared.values():
+            inputs.share_memory()
+        with ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker,
+                                 initargs=(prepared, threads_per_worker, multiprocessing.get_start_method())) as pool:
+            futures = [pool.submit(_run_config, run, run_dir, config, common) for run, run_dir, config in runs]
+            rows = [future.result() for future in futures]
+
+    summary = pd.DataFrame(rows)
+    summary.to_csv('{}_summary.csv'.format(resultsdir), index=False)
+    return summary
@@ -0,0 +1,73 @@
+### Full training state checkpoints, used to resume an interrupted muse_fit_predict
+import os
+import copy
+import random
+import numpy as np
+import torch
+
+
+def get_rng_state():
+    ''' RNG states of python, numpy and torch (and CUDA when available).
+    '''
+    state = dict(python=random.getstate(), numpy=np.random.get_state(), torch=torch.get_rng_state())
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def _to_cpu(obj):
+    # detached CPU copy of every tensor in a nested dict/list
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().cpu().clone()
+    if isinstance(obj, dict):
+        return {key: _to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(value) for value in obj)
+    return copy.deepcopy(obj)
+
+def snapshot_training_state(phase, epoch, model, optimizer, labels, train_subset, cluster_backend,
+                            pending_clustering=None, convergence=None):
+    ''' Copy everything needed to continue training at (phase, epoch).
+
+    Args:
+        phase: name of the phase ('init_recon', 'init_both' or 'train')
+        epoch: next epoch to run in that phase
+        model, optimizer: the structured_embedding and its optimizer
+        labels: dict of the current label tensors / PairwiseLabels and flags
+        train_subset: rows used for training
+        cluster_backend: backend whose state (e.g. previous partition) is kept
+        pending_clustering: (datasets, snapshot_epoch) of an unfinished asynchronous
+            clustering job, resubmitted on resume
+        convergence: {phase: [criteria]} whose progress is kept
+
+    Return:
+        dict, safe to serialize on another thread
+    '''
+    return dict(phase=phase,
+                epoch=epoch,
+                model=_to_cpu(model.state_dict()),
+                optimizer=_to_cpu(optimizer.state_dict()),
+                rng=get_rng_state(),
+                # labels are replaced, never modified in place, so references are enough
+                labels=dict(labels),
+                train_subset=list(train_subset),
+                cluster_backend=copy.deepcopy(cluster_backend),
+                pending_clustering=pending_clustering,
+                convergence=copy.deepcopy(convergence))
+
+def save_training_state(state, fname):
+    ''' Write a state from `snapshot_training_state`; the previous file is only
+        replaced once the new one is complete.
+    '''
+    tmp = '{}.tmp'.format(fname)
+    torch.save(state, tmp)
+    os.replace(tmp, fname)
+
+def load_training_state(fname, device='cpu'):
+    return torch.load(fname, map_location=device, weights_only=False)
@@ -5,17 +5,49 @@ CONVERTED TO PYTORCH LVS
 '''
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
-def _pairwise_distances(embeddings, device):
+def _pairwise_distances(embeddings, device, metric='cosine', normalized=False):
     """Compute the 2D matrix of distances between all the embeddings.
+    All pairs come from one (batch_size, embed_dim) x (embed_dim, batch_size) matmul.
     Args:
         embeddings: tensor of shape (batch_size, embed_dim)
+        metric: 'cosine' (1 - cosine similarity) or 'euclidean'
+        normalized: the embeddings are unit-norm (e.g. l2_norm=True), so the norms are skipped
     Returns:
         pairwise_distances: tensor of shape (batch_size, batch_size)
     """
-    distances = 1 - torch.nn.functional.cosine_similarity(embeddings[:,:,None], embeddings.t()[None,:,:])
+    dot_product = torch.matmul(embeddings, embeddings.t())
+    if normalized:
+        square_norm = torch.ones(embeddings.size()[0], dtype=embeddings.dtype, device=embeddings.device)
+    else:
+        square_norm = torch.sum(torch.square(embeddings), dim=1)
 
-    return distances
+    if metric == 'cosine':
+        # rounding can take 1 - cos slightly below 0 (e.g. self distances)
+        if normalized:
+            return (1 - dot_product).clamp(min=0.0)
+        # same eps as torch.nn.functional.cosine_similarity
+        norm = torch.sqrt(square_norm).clamp(min=1e-8)
+        return (1 - dot_product / (norm[:, None] * norm[None, :])).clamp(min=0.0)
+    elif metric == 'euclidean':
+        distances = (square_norm[:, None] - 2.0 * dot_product + square_norm[None, :]).clamp(min=0.0)
+        # the gradient of sqrt is infinite at 0: shift exact zeros, then reset them
+        mask = torch.eq(distances, 0.0).float()
+        distances = torch.sqrt(distances + mask * 1e-16)
+        return distances * (1.0 - mask)
+    else:
+        raise ValueError('Please choose metric "cosine" or "euclidean"!')
+
+def _get_label_equal(labels):
+    """Return a 2D bool mask where mask[i, j] is True iff i and j share a label.
+    Args:
+        labels: cluster ids of shape (batch_size,), or a co-membership matrix of
+            shape (batch_size, batch_size) where > 0 means same cluster
+    """
+    if labels.dim() == 1:
+        return torch.eq(torch.unsqueeze(labels, 1), torch.unsqueeze(labels, 0))
+    return labels > 0
 
 def _get_triplet_mask(labels, device):
     """Return a 3D mask where mask[a, p, n] is True iff the triplet (a, p, n) is valid.
@@ -23,7 +55,8 @@ def _get_triplet_mask(labels, device):
         - i, j, k are distinct
         - labels[i] == labels[j] and labels[i] != labels[k]
     Args:
-        labels: tf.int32 `Tensor` with shape [batch_size]
+        labels: int `Tensor` of cluster ids with shape [batch_size], or a
+            [batch_size, batch_size] co-membership matrix
     """
     # Check that i, j and k are distinct
     indices_equal = torch.eye(labels.size()[0]).bool().to(device)
@@ -35,7 +68,7 @@ def _get_triplet_mask(labels, device):
     distinct_indices = torch.logical_and(torch.logical_and(i_not_equal_j, i_not_equal_k), j_not_equal_k)
 
     # Check if labels[i] == labels[j] and labels[i] != labels[k]
-    label_equal = labels > 0
+    label_equal = _get_label_equal(labels)
     i_equal_j = torch.unsqueeze(label_equal, 2)
     i_equal_k = torch.unsqueeze(label_equal, 1)
 
@@ -47,6 +80,61 @@ def _get_triplet_mask(labels, device):
     return mask
 
 
+def _get_anchor_triplet_mask(label_equal, start, stop, device):
+    """Return the rows [start, stop) of the mask built by `_get_triplet_mask`.
+    Only the anchors in the block are materialized, so the mask has shape
+    (stop - start, batch_size, batch_size) instead of the full cube.
+    Args:
+        label_equal: bool tensor of shape (batch_size, batch_size)
+        start: first anchor of the block
+        stop: anchor after the last one of the block
+    """
+    batch_size = label_equal.size()[0]
+    anchors = torch.arange(start, stop, device=device)
+    indices = torch.arange(batch_size, device=device)
+
+    # Check that i, j and k are distinct
+    anchor_not_equal = torch.ne(anchors[:, None], indices[None, :])
+    indices_not_equal = torch.logical_not(torch.eye(batch_size, dtype=torch.bool, device=device))
+    distinct_indices = torch.logical_and(torch.logical_and(torch.unsqueeze(anchor_not_equal, 2),
+                                                           torch.unsqueeze(anchor_not_equal, 1)),
+                                         torch.unsqueeze(indices_not_equal, 0))
+
+    # Check if labels[i] == labels[j] and labels[i] != labels[k]
+    anchor_label_equal = label_equal[start:stop]
+    valid_labels = torch.logical_and(torch.unsqueeze(anchor_label_equal, 2),
+                                     torch.logical_not(torch.unsqueeze(anchor_label_equal, 1)))
+
+    return torch.logical_and(distinct_indices, valid_labels)
+
+
+def _triplet_block(pairwise_dist, label_equal, start, stop, margin, device):
+    """Reduce the triplets of anchors [start, stop) to sums, counts and per-anchor maxes.
+    Only a (stop - start, batch_size, batch_size) slice of the cube is alive at once.
+    """
+    block_dist = pairwise_dist[start:stop]
+    mask = _get_anchor_triplet_mask(label_equal, start, stop, device)
+
+    # triplet_loss[i, j, k] will contain the triplet loss of anchor=start+i, positive=j, negative=k
+    triplet_loss = torch.unsqueeze(block_dist, 2) - torch.unsqueeze(block_dist, 1) + margin
+    triplet_loss = triplet_loss.masked_fill(torch.logical_not(mask), 0)
+
+    num_easy = torch.sum(torch.less(triplet_loss, 0))
+    num_semi_hard = torch.sum(torch.logical_and(torch.greater(triplet_loss, 0), torch.less(triplet_loss, margin)))
+    num_hard = torch.sum(torch.greater(triplet_loss, margin))
+
+    # Remove negative losses (i.e. the easy triplets)
+    triplet_loss = torch.clamp(triplet_loss, min=0)
+    loss_sum = torch.sum(triplet_loss)
+    num_positive = torch.sum(torch.greater(triplet_loss, 1e-16))
+
+    num_valid = torch.sum(mask)
+    anchor_maxes = torch.amax(triplet_loss, dim=(1, 2))
+    anchor_valid = torch.any(mask.flatten(1), dim=1)
+
+    return loss_sum, anchor_maxes, num_positive, num_valid, num_easy, num_semi_hard, num_hard, anchor_valid
+
+
 def batch_all_triplet_loss(labels, embeddings, margin, device):
     """Build the triplet loss over a batch of embeddings.
     We generate all the valid triplets and average the loss over the positive ones.
@@ -172,4 +260,88 @@ def batch_hard_triplet_loss(labels, embeddings, margin, device):
     maxes = torch.amax(triplet_loss,dim=(1,2))
     triplet_loss = torch.mean(maxes[mask.sum(dim=(1,2)) > 0]) 
 
-    return triplet_loss
\ No newline at end of file
+    return triplet_loss
+
+def batch_triplet_losses(labels, embeddings, margin, device, pairwise_dist=None, chunk_size=None, metric='cosine',
+                         normalized=False):
+    """Compute the batch-all loss, the batch-hard loss and the triplet fractions in one pass.
+    Equivalent to calling `batch_all_triplet_loss`, `batch_hard_triplet_loss` and
+    `fraction_triplets`, but the distance matrix and the mask are built once.
+    Args:
+        labels: labels of the batch, of size (batch_size,) or (batch_size, batch_size)
+        embeddings: tensor of shape (batch_size, embed_dim)
+        margin: margin for triplet loss
+        pairwise_dist: optional precomputed output of `_pairwise_distances` for `embeddings`,
+            to share the distance matrix between several label matrices
+        chunk_size: if set, anchors are processed in blocks of this size so that at most
+            chunk_size x batch_size x batch_size elements are alive at once; with gradients
+            enabled each block is recomputed during backward instead of being stored
+        metric, normalized: distance of `_pairwise_distances`, if pairwise_dist is not given
+    Returns:
+        batch_all_loss, batch_hard_loss, fraction_easy, fraction_semi_hard, fraction_hard
+    """
+    if pairwise_dist is None:
+        pairwise_dist = _pairwise_distances(embeddings, device, metric, normalized)
+    label_equal = _get_label_equal(labels)
+    batch_size = pairwise_dist.size()[0]
+
+    if chunk_size is None or chunk_size >= batch_size:
+        blocks = [_triplet_block(pairwise_dist, label_equal, 0, batch_size, margin, device)]
+    else:
+        blocks = []
+        for start in range(0, batch_size, chunk_size):
+            stop = min(start + chunk_size, batch_size)
+            if torch.is_grad_enabled() and pairwise_dist.requires_grad:
+                blocks.append(checkpoint(_triplet_block, pairwise_dist, label_equal, start, stop, margin, device,
+                                         use_reentrant=False))
+            else:
+                blocks.append(_triplet_block(pairwise_dist, label_equal, start, stop, margin, device))
+
+    loss_sums, anchor_maxes, num_positives, num_valids, num_easys, num_semi_hards, num_hards, anchor_valids = zip(*blocks)
+    loss_sum = sum(loss_sums)
+    num_positive = sum(num_positives)
+    num_valid = sum(num_valids)
+    num_easy = sum(num_easys)
+    num_semi_hard = sum(num_semi_hards)
+    num_hard = sum(num_hards)
+    anchor_maxes = torch.cat(anchor_maxes)
+    anchor_valid = torch.cat(anchor_valids)
+
+    # Get final mean triplet loss over the positive valid triplets
+    batch_all_loss = loss_sum / (num_positive + 1e-16)
+    # Mean of the hardest triplet of every anchor that has at least one valid triplet
+    # (masked sum instead of boolean indexing, whose data-dependent shape syncs with the host)
+    batch_hard_loss = (anchor_maxes * anchor_valid).sum() / anchor_valid.sum().clamp(min=1)
+
+    fraction_easy_triplets = num_easy / (num_valid + 1e-16)
+    fraction_semi_hard_triplets = num_semi_hard / (num_valid + 1e-16)
+    fraction_hard_triplets = num_hard / (num_valid + 1e-16)
+
+    return batch_all_loss, batch_hard_loss, fraction_easy_triplets, fraction_semi_hard_triplets, fraction_hard_triplets
+
+def paired_triplet_losses(labels_x, labels_y, embeddings, margin, device, chunk_size=None, metric='cosine',
+                          normalized=False):
+    """Compute `batch_triplet_losses` for two label sets of the same embeddings, sharing
+    one distance matrix. The distances and losses are computed in float32, also when
+    called under autocast, so low-precision embeddings don't distort the cosine distances;
+    normalized low-precision embeddings are renormalized in float32.
+    Args:
+        labels_x, labels_y: labels of the batch, see `batch_triplet_losses`
+        embeddings: tensor of shape (batch_size, embed_dim)
+        margin: margin for triplet loss
+        chunk_size: anchor block size, see `batch_triplet_losses`
+        metric, normalized: distance of `_pairwise_distances`
+    Returns:
+        the `batch_triplet_losses` tuples of labels_x and labels_y
+    """
+    with torch.autocast(embeddings.device.type, enabled=False):
+        if normalized and embeddings.dtype != torch.float32:
+            # normalized in low precision (autocast): the norms are only ~1e-3 close to 1
+            embeddings = torch.nn.functional.normalize(embeddings.float(), dim=1)
+        embeddings = embeddings.float()
+        pairwise_dist = _pairwise_distances(embeddings, device, metric, normalized)
+        losses_x = batch_triplet_losses(labels_x, embeddings, margin, device, pairwise_dist=pairwise_dist,
+                                        chunk_size=chunk_size)
+        losses_y = batch_triplet_losses(labels_y, embeddings, margin, device, pairwise_dist=pairwise_dist,
+                                        chunk_size=chunk_size)
+    return losses_x, losses_y